@@ -0,0 +1,463 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright(c) 2014 palmhold.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Non-blocking memcache client for coroutine handlers.
+
+Speaks the memcache text protocol over Tornado IOStreams and stores values
+with the flags of python-memcache, so both clients share the same servers
+and read each other's values::
+
+    value = yield cache.manager.aio.get("key")
+
+Concurrent gets to the same server issued during one IOLoop iteration are
+sent as one multi-key get, written along with any other pending get on a
+pooled connection without waiting for the replies in between.
+"""
+
+import logging
+import pickle
+import re
+import time
+import zlib
+
+from datetime import timedelta
+
+import memcache
+from six import PY2, binary_type, integer_types, iteritems, text_type
+from tornado import gen, locks
+from tornado.concurrent import Future
+from tornado.escape import utf8
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+from tornado.tcpclient import TCPClient
+
+from .breaker import CircuitBreaker
+from .hashring import HashRing
+
+logger = logging.getLogger(__name__)
+
+# Same flags as python-memcache
+_FLAG_PICKLE = 1 << 0
+_FLAG_INTEGER = 1 << 1
+_FLAG_LONG = 1 << 2
+_FLAG_COMPRESSED = 1 << 3
+_FLAG_TEXT = 1 << 4
+
+_INVALID_KEY_RE = re.compile(b"[\x00-\x20\x7f]")
+_MAX_KEY_LENGTH = 250
+
+# Keys per get command, a longer request line is split into several
+# commands written back to back.
+_GET_BATCH = 100
+
+
+class _Error(Exception):
+    """The server answered something unexpected."""
+
+
+def _encode_key(key):
+    key = utf8(key)
+    if len(key) > _MAX_KEY_LENGTH:
+        raise memcache.Client.MemcachedKeyLengthError(
+            "Key length is > %s" % _MAX_KEY_LENGTH)
+    if _INVALID_KEY_RE.search(key):
+        raise memcache.Client.MemcachedKeyCharacterError(
+            "Control/space characters not allowed (key=%r)" % key)
+    return key
+
+
+def _to_store(value):
+    """Returns (flags, data) as python-memcache stores value."""
+    value_type = type(value)
+    if value_type is binary_type:
+        return 0, value
+    if value_type is text_type:
+        return _FLAG_TEXT, value.encode("utf-8")
+    if value_type is int:
+        return _FLAG_INTEGER, utf8("%d" % value)
+    if PY2 and value_type in integer_types:
+        return _FLAG_LONG, utf8("%d" % value)
+    return _FLAG_PICKLE, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+
+def _from_store(flags, data):
+    if flags & _FLAG_COMPRESSED:
+        data = zlib.decompress(data)
+        flags &= ~_FLAG_COMPRESSED
+    if flags == 0:
+        return data
+    if flags & _FLAG_TEXT:
+        return data.decode("utf-8")
+    if flags & (_FLAG_INTEGER | _FLAG_LONG):
+        return int(data)
+    if flags & _FLAG_PICKLE:
+        return pickle.loads(data)
+    raise ValueError("Unknown flags on get: %x" % flags)
+
+
+def _parse_server(server):
+    weight = 1
+    if isinstance(server, tuple):
+        server, weight = server
+    if server.startswith("inet:"):
+        server = server[5:]
+    host, _, port = server.partition(":")
+    return host, int(port or 11211), int(weight)
+
+
+class _Server(object):
+    """A memcached server and its pool of connections."""
+
+    def __init__(self, host, port, weight=1, pool_size=4, connect_timeout=1,
+                 dead_retry=30, breaker=None):
+        self.host = host
+        self.port = port
+        self.weight = weight
+        self.connect_timeout = connect_timeout
+        self.dead_retry = dead_retry
+        self.dead_until = 0
+        self.breaker = breaker
+        self.pending = {}
+        self._idle = []
+        self._slots = locks.Semaphore(pool_size)
+
+    def __str__(self):
+        return "%s:%d" % (self.host, self.port)
+
+    def alive(self):
+        if self.breaker is not None:
+            return self.breaker.allow()
+        return self.dead_until <= time.time()
+
+    def mark_dead(self, reason):
+        logger.warning("memcache server %s error: %s", self, reason)
+        if self.breaker is not None:
+            self.breaker.failure()
+        else:
+            self.dead_until = time.time() + self.dead_retry
+
+    def mark_alive(self):
+        if self.breaker is not None:
+            self.breaker.success()
+
+    @gen.coroutine
+    def acquire(self):
+        yield self._slots.acquire()
+        while self._idle:
+            stream = self._idle.pop()
+            if not stream.closed():
+                raise gen.Return(stream)
+
+        try:
+            stream = yield gen.with_timeout(
+                timedelta(seconds=self.connect_timeout),
+                TCPClient().connect(self.host, self.port))
+        except Exception:
+            self._slots.release()
+            raise
+        stream.set_nodelay(True)
+        raise gen.Return(stream)
+
+    def release(self, stream, broken=False):
+        if broken or stream.closed():
+            stream.close()
+        else:
+            self._idle.append(stream)
+        self._slots.release()
+
+    def close(self):
+        while self._idle:
+            self._idle.pop().close()
+
+
+class AsyncMemcacheClient(object):
+    """Coroutine memcache client with the API of CacheManager.
+
+    Keys map to servers like in python-memcache, or like in
+    hashring.Client with consistent_hash. Network errors and
+    timeouts are logged and read as misses or failed writes. A failed
+    server is skipped for dead_retry seconds, or while its circuit is open
+    when breakers, a dict of breaker.CircuitBreaker by "host:port", is
+    given.
+
+    codec is the codec.Codec of the CacheManager sharing the servers, and
+    invalidate a callable given the keys written, used to drop them from
+    its local cache.
+    """
+
+    def __init__(self, servers, timeout=3, pool_size=4, socket_timeout=3,
+                 connect_timeout=1, dead_retry=30, codec=None,
+                 invalidate=None, consistent_hash=False, breakers=None):
+        self.default_timeout = int(timeout)
+        self.socket_timeout = socket_timeout
+        self.codec = codec
+        self.invalidate = invalidate
+        self.servers = []
+        self.buckets = []
+        for server in servers:
+            host, port, weight = _parse_server(server)
+            server = _Server(host, port, weight, pool_size, connect_timeout,
+                             dead_retry)
+            if breakers is not None:
+                if str(server) not in breakers:
+                    breakers[str(server)] = CircuitBreaker(str(server))
+                server.breaker = breakers[str(server)]
+            self.servers.append(server)
+            self.buckets.extend([server] * weight)
+        self.ring = None
+        if consistent_hash:
+            self.ring = HashRing([(str(s), s, s.weight)
+                                  for s in self.servers])
+
+    def _server(self, key):
+        if self.ring is not None:
+            for server in self.ring.iter_nodes(key):
+                if server.alive():
+                    return server
+            return None
+
+        # python-memcache picks its other buckets when the server is down,
+        # ours only ever use the first one.
+        if not self.buckets:
+            return None
+        server = self.buckets[
+            memcache.serverHashFunction(key) % len(self.buckets)]
+        return server if server.alive() else None
+
+    def _to_store(self, value):
+        if self.codec is not None:
+            value = self.codec.encode(value)
+        return _to_store(value)
+
+    def _from_store(self, flags, data):
+        value = _from_store(flags, data)
+        if self.codec is not None:
+            value = self.codec.decode(value)
+        return value
+
+    @gen.coroutine
+    def _call(self, server, request, reader):
+        """Writes request to a pooled connection and returns reader(stream).
+        """
+        try:
+            stream = yield server.acquire()
+        except Exception as e:
+            server.mark_dead(e)
+            raise
+
+        broken = True
+        try:
+            stream.write(request)
+            result = yield gen.with_timeout(
+                timedelta(seconds=self.socket_timeout), reader(stream),
+                quiet_exceptions=(StreamClosedError,))
+            broken = False
+        except Exception as e:
+            server.mark_dead(e)
+            raise
+        finally:
+            server.release(stream, broken)
+        server.mark_alive()
+        raise gen.Return(result)
+
+    @gen.coroutine
+    def _command(self, key, request, default=None):
+        """Sends a single line command and returns the reply line."""
+        server = self._server(key)
+        if server is None:
+            raise gen.Return(default)
+
+        @gen.coroutine
+        def reader(stream):
+            line = yield stream.read_until(b"\r\n")
+            raise gen.Return(line[:-2])
+
+        try:
+            line = yield self._call(server, request, reader)
+        except (StreamClosedError, gen.TimeoutError, IOError):
+            # logged by server.mark_dead
+            raise gen.Return(default)
+        raise gen.Return(line)
+
+    def _enqueue(self, key):
+        future = Future()
+        server = self._server(key)
+        if server is None:
+            future.set_result(None)
+            return future
+
+        if not server.pending:
+            IOLoop.current().add_callback(self._flush, server)
+        server.pending.setdefault(key, []).append(future)
+        return future
+
+    @gen.coroutine
+    def _flush(self, server):
+        pending, server.pending = server.pending, {}
+        keys = list(pending)
+        batches = [keys[i:i + _GET_BATCH]
+                   for i in range(0, len(keys), _GET_BATCH)]
+        request = b"".join(b"get " + b" ".join(batch) + b"\r\n"
+                           for batch in batches)
+
+        @gen.coroutine
+        def reader(stream):
+            values = {}
+            for _ in batches:
+                while True:
+                    line = yield stream.read_until(b"\r\n")
+                    if line == b"END\r\n":
+                        break
+                    parts = line.split()
+                    if len(parts) < 4 or parts[0] != b"VALUE":
+                        raise _Error(line)
+                    try:
+                        flags, length = int(parts[2]), int(parts[3])
+                    except ValueError:
+                        raise _Error(line)
+                    data = yield stream.read_bytes(length + 2)
+                    values[parts[1]] = (flags, data[:-2])
+            raise gen.Return(values)
+
+        values = {}
+        try:
+            values = yield self._call(server, request, reader)
+        except (StreamClosedError, gen.TimeoutError, IOError, _Error):
+            # logged by server.mark_dead
+            pass
+        finally:
+            # anything else still resolves the waiting gets as misses
+            for key, futures in iteritems(pending):
+                value = None
+                if key in values:
+                    try:
+                        value = self._from_store(*values[key])
+                    except Exception:
+                        logger.exception("memcache bad value of %r", key)
+                for future in futures:
+                    if not future.done():
+                        future.set_result(value)
+
+    @gen.coroutine
+    def get(self, key, default=None):
+        value = yield self._enqueue(_encode_key(key))
+        raise gen.Return(default if value is None else value)
+
+    @gen.coroutine
+    def get_many(self, keys):
+        keys = dict((_encode_key(key), key) for key in keys)
+        futures = dict((key, self._enqueue(key)) for key in keys)
+        values = yield futures
+        raise gen.Return(dict((keys[key], value)
+                              for key, value in iteritems(values)
+                              if value is not None))
+
+    def _store_request(self, command, key, value, timeout):
+        flags, data = self._to_store(value)
+        return b"".join([
+            utf8("%s " % command), key,
+            utf8(" %d %d %d\r\n" % (flags, timeout or self.default_timeout,
+                                    len(data))),
+            data, b"\r\n"])
+
+    @gen.coroutine
+    def _store(self, command, key, value, timeout):
+        # a failed add leaves nothing to invalidate
+        if self.invalidate is not None and command != "add":
+            self.invalidate([key])
+        encoded = _encode_key(key)
+        line = yield self._command(
+            encoded, self._store_request(command, encoded, value, timeout))
+        stored = line == b"STORED"
+        if self.invalidate is not None and command == "add" and stored:
+            self.invalidate([key])
+        raise gen.Return(stored)
+
+    def add(self, key, value, timeout=0):
+        return self._store("add", key, value, timeout)
+
+    def set(self, key, value, timeout=0):
+        return self._store("set", key, value, timeout)
+
+    def replace(self, key, value, timeout=0):
+        return self._store("replace", key, value, timeout)
+
+    @gen.coroutine
+    def set_many(self, mapping, timeout=0):
+        """Sets all items of mapping, returns the keys that failed."""
+        keys = dict((_encode_key(key), key) for key in mapping)
+        if self.invalidate is not None:
+            self.invalidate(list(mapping))
+
+        by_server, failed = {}, []
+        for key, orig_key in iteritems(keys):
+            server = self._server(key)
+            if server is None:
+                failed.append(orig_key)
+            else:
+                by_server.setdefault(server, []).append(key)
+
+        @gen.coroutine
+        def send(server, server_keys):
+            request = b"".join(
+                self._store_request("set", key, mapping[keys[key]], timeout)
+                for key in server_keys)
+
+            @gen.coroutine
+            def reader(stream):
+                lines = []
+                for _ in server_keys:
+                    line = yield stream.read_until(b"\r\n")
+                    lines.append(line[:-2])
+                raise gen.Return(lines)
+
+            try:
+                lines = yield self._call(server, request, reader)
+            except (StreamClosedError, gen.TimeoutError, IOError):
+                lines = []
+            raise gen.Return([keys[key] for key, line in
+                              zip(server_keys, lines + [None] *
+                                  (len(server_keys) - len(lines)))
+                              if line != b"STORED"])
+
+        results = yield [send(server, server_keys)
+                         for server, server_keys in iteritems(by_server)]
+        for result in results:
+            failed.extend(result)
+        raise gen.Return(failed)
+
+    @gen.coroutine
+    def delete(self, key):
+        if self.invalidate is not None:
+            self.invalidate([key])
+        key = _encode_key(key)
+        line = yield self._command(key, b"delete " + key + b"\r\n")
+        raise gen.Return(line in (b"DELETED", b"NOT_FOUND"))
+
+    @gen.coroutine
+    def incr(self, key, delta=1):
+        """Increments key by delta, returns the new value or None."""
+        if self.invalidate is not None:
+            self.invalidate([key])
+        key = _encode_key(key)
+        command = b"incr " if delta >= 0 else b"decr "
+        line = yield self._command(
+            key, command + key + utf8(" %d\r\n" % abs(delta)))
+        raise gen.Return(int(line) if line and line.isdigit() else None)
+
+    def close(self):
+        for server in self.servers:
+            server.close()
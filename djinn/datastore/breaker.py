@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright(c) 2014 palmhold.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Circuit breakers for memcache servers.
+
+A breaker opens after failure_threshold consecutive failures of its server
+and calls skip the server right away instead of waiting for the socket
+timeout. After cooldown seconds a single call is let through (half-open):
+its success closes the breaker, its failure opens it again for twice as
+long, up to max_cooldown.
+"""
+
+import collections
+import logging
+import threading
+import time
+
+import memcache
+from tornado.options import define, options
+
+from .hashring import host_name
+
+define("cache_breaker_threshold", 5, int,
+       "consecutive failures opening the circuit of a memcache server, "
+       "0 to only rely on python-memcache's dead_retry")
+define("cache_breaker_cooldown", 1.0, float,
+       "seconds a memcache server is skipped once its circuit opens")
+define("cache_breaker_max_cooldown", 60.0, float,
+       "upper bound of the doubling cooldown of a memcache server")
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitBreaker(object):
+
+    def __init__(self, name, failure_threshold=None, cooldown=None,
+                 max_cooldown=None):
+        self.name = name
+        self.failure_threshold = failure_threshold or \
+            options.cache_breaker_threshold
+        self.base_cooldown = cooldown or options.cache_breaker_cooldown
+        self.max_cooldown = max_cooldown or options.cache_breaker_max_cooldown
+        self.state = CLOSED
+        self.failures = 0
+        self.cooldown = self.base_cooldown
+        self.opened_at = 0
+        self.probe_at = 0
+        self.transitions = collections.Counter()
+        self._lock = threading.Lock()
+
+    def _transition(self, state):
+        logger.warning("memcache server %s circuit %s -> %s%s", self.name,
+                       self.state, state,
+                       " for %.1fs" % self.cooldown if state == OPEN else "")
+        self.state = state
+        self.transitions[state] += 1
+
+    def allow(self):
+        """Whether a call may go to the server now."""
+        if self.state == CLOSED:
+            return True
+
+        now = time.time()
+        with self._lock:
+            if self.state == OPEN:
+                if now < self.opened_at + self.cooldown:
+                    return False
+                self._transition(HALF_OPEN)
+            elif now < self.probe_at + self.cooldown:
+                # the probe call is still out
+                return False
+            self.probe_at = now
+            return True
+
+    def success(self):
+        if self.state == CLOSED and not self.failures:
+            return
+        with self._lock:
+            self.failures = 0
+            if self.state != CLOSED:
+                self.cooldown = self.base_cooldown
+                self._transition(CLOSED)
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == HALF_OPEN:
+                self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+            elif self.state == OPEN or \
+                    self.failures < self.failure_threshold:
+                return
+            self.opened_at = time.time()
+            self._transition(OPEN)
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "cooldown": self.cooldown,
+            "transitions": dict(self.transitions),
+        }
+
+
+class Host(memcache._Host):
+    """python-memcache host reporting to a CircuitBreaker.
+
+    Its clients are built with dead_retry=0, the breaker deciding alone
+    when a failed server is tried again.
+    """
+
+    breaker = None
+
+    def connect(self):
+        if not self.breaker.allow():
+            return 0
+        return memcache._Host.connect(self)
+
+    def mark_dead(self, reason):
+        self.breaker.failure()
+        memcache._Host.mark_dead(self, reason)
+
+    def readline(self, raise_exception=False):
+        line = memcache._Host.readline(self, raise_exception)
+        if line:
+            self.breaker.success()
+        return line
+
+
+def attach(client, servers, breakers):
+    """Replaces the hosts of client by Hosts using the breakers by name.
+
+    breakers is a dict of the CircuitBreakers kept across clients, missing
+    ones are added.
+    """
+    hosts = []
+    for server in servers:
+        host = Host(server, debug=client.debug, dead_retry=0,
+                    socket_timeout=client.socket_timeout,
+                    flush_on_reconnect=client.flush_on_reconnect)
+        name = host_name(host)
+        if name not in breakers:
+            breakers[name] = CircuitBreaker(name)
+        host.breaker = breakers[name]
+        hosts.append(host)
+    client.servers = hosts
+    client._init_buckets()
+    return client
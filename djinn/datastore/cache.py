@@ -17,38 +17,250 @@
 import hashlib
 import logging
 import functools
+import re
+import time
+
+from concurrent.futures import ThreadPoolExecutor
 
 import memcache
-from six import PY2, iteritems
-from tornado.escape import utf8
+from six import (PY2, binary_type, integer_types, iteritems, string_types,
+                 text_type)
+from tornado.escape import to_unicode, utf8
+from tornado.ioloop import IOLoop
 from tornado.options import define, options
 
+from . import breaker, hashring
+from .codec import Codec
+from .localcache import Invalidator, LocalCache
+
 define("cache_key_prefix", "", str, "cache key prefix to avoid key conflict")
 define("cache_enabled", True, bool, "whether cache is enabled")
+define("cache_negative_timeout", 60, int,
+       "seconds empty results (None, 0, [], ...) are cached, 0 to disable")
+define("cache_namespace_ttl", 1.0, float,
+       "seconds namespace versions are kept in-process")
 manager = None
 
 logger = logging.getLogger(__name__)
 
 
-def cache(key=None, timeout=3600, args_as_key=True):
+def cache(key=None, timeout=3600, args_as_key=True, stale_timeout=60,
+          lock_timeout=10, wait=0.1, background=False, negative_timeout=None,
+          key_mode="sorted", namespace=None):
+    """Caches the result of a method in memcache.
+
+    Results are fresh for timeout seconds and then served stale for up to
+    stale_timeout more seconds while a single caller, the one winning a
+    lease taken with memcache add, recomputes them. With background, the
+    lease holder refreshes the entry in a worker thread and gets the stale
+    value right away too.
+
+    When there is nothing stale to serve, callers losing the lease poll
+    memcache for up to wait seconds for the holder's result before
+    computing it themselves, unless they run on an IOLoop thread, which
+    must not block. Callers compute right away when memcache is down.
+
+    Empty results (None, 0, [], "", ...) are cached too, for
+    negative_timeout seconds (cache_negative_timeout by default), so
+    lookups of missing ids do not hit the database every time.
+
+    Without key, keys are generated from the method and its arguments as
+    described by KeyGenerator for key_mode. Keys include the versions of
+    namespace, see KeyGenerator, so invalidate_namespace drops them all::
+
+        @cache(namespace="user:%s")
+        def get_orders(self, user_id, status):
+            ...
+
+        invalidate_namespace("user:%s" % user_id)
+    """
     def _wrapper(func):
+        make_key = KeyGenerator(key, func, args_as_key, key_mode, namespace)
+
         @functools.wraps(func)
         def __wrapper(self, *args, **kw):
             if not options.cache_enabled:
                 return func(self, *args, **kw)
-            _key = key_gen(key, func, args_as_key, *args, **kw)
-            value = manager.get(_key)
-            if not value:
-                value = func(self, *args, **kw)
-                if value:
-                    manager.set(_key, value, timeout)
-
-            return value
+            _key = make_key(*args, **kw)
+            timeouts = (timeout, stale_timeout,
+                        options.cache_negative_timeout
+                        if negative_timeout is None else negative_timeout)
+
+            def compute():
+                return func(self, *args, **kw)
+
+            found, value, fresh = _unwrap(manager.get(_key))
+            if found and fresh:
+                return value
+
+            leased = _lease(_key, lock_timeout)
+            if leased:
+                if found and background:
+                    _refresh_executor.submit(_refresh_in_background, _key,
+                                             compute, timeouts)
+                    return value
+                return _refresh(_key, compute, timeouts)
+            elif found:
+                return value
+            elif leased is None or \
+                    IOLoop.current(instance=False) is not None:
+                return compute()
+
+            deadline = time.time() + wait
+            while time.time() < deadline:
+                time.sleep(0.02)
+                found, value, _ = _unwrap(manager.get(_key))
+                if found:
+                    return value
+            return compute()
+
+        return __wrapper
+
+    return _wrapper
+
+
+def cache_many(key, timeout=3600, negative_timeout=None, namespace=None):
+    """Caches the results of a method taking a list of ids, id by id.
+
+    key is a pattern like "user:%s" giving the key of every id. All keys
+    are fetched with one get_many, the method is only called with the
+    missing ids, and their results are written back with one set_many
+    (plus one for empty results, cached negative_timeout seconds).
+
+    The method returns either a dict mapping ids to values or a list of
+    values ordered like the ids it got. The decorated method returns the
+    values ordered like the ids it was called with, None for the ids the
+    method did not return.
+
+    namespace is a name, a list of names or a callable given the other
+    arguments of the method, whose versions are part of every key::
+
+        @cache_many("user:%s", namespace="users")
+        def get_users(self, ids):
+            return dict((row.id, row) for row in db.query(
+                "SELECT * FROM users WHERE id IN %s", tuple(ids)))
+    """
+    make_key = KeyGenerator(key)
+
+    def _wrapper(func):
+        @functools.wraps(func)
+        def __wrapper(self, ids, *args, **kw):
+            ids = list(ids)
+            if not options.cache_enabled:
+                values = _as_dict(ids, func(self, ids, *args, **kw))
+                return [values.get(i) for i in ids]
+
+            keys = dict((i, make_key(i)) for i in ids)
+            if namespace:
+                names = namespace(*args, **kw) if callable(namespace) \
+                    else namespace
+                suffix = namespaces.suffix(
+                    [names] if isinstance(names, string_types) else names)
+                keys = dict((i, k + suffix) for i, k in iteritems(keys))
+            values = fetch_many(
+                keys, lambda missing: _as_dict(
+                    missing, func(self, missing, *args, **kw)),
+                timeout, negative_timeout)
+            return [values.get(i) for i in ids]
+
         return __wrapper
 
     return _wrapper
 
 
+def fetch_many(keys, fetch, timeout=3600, negative_timeout=None):
+    """Returns a dict of the values of ids, keys mapping ids to cache keys.
+
+    All keys are read with one get_many. fetch is called with the list of
+    the ids missing or stale and returns a dict of their values, which are
+    written back with one set_many (plus one for empty values, cached
+    negative_timeout seconds).
+    """
+    cached = manager.get_many(list(set(keys.values()))) or {}
+    values, missing = {}, []
+    for i in keys:
+        found, value, fresh = _unwrap(cached.get(keys[i]))
+        if found and fresh:
+            values[i] = value
+        else:
+            missing.append(i)
+
+    if missing:
+        fetched = fetch(missing)
+        negative = options.cache_negative_timeout \
+            if negative_timeout is None else negative_timeout
+        now = time.time()
+        entries, empty = {}, {}
+        for i in missing:
+            value = values[i] = fetched.get(i)
+            if value:
+                entries[keys[i]] = (_ENVELOPE, now + timeout, value)
+            else:
+                empty[keys[i]] = (_ENVELOPE, now + negative, value)
+        if entries:
+            manager.set_many(entries, timeout)
+        if empty and negative:
+            manager.set_many(empty, negative)
+
+    return values
+
+
+def _as_dict(ids, values):
+    if isinstance(values, dict):
+        return values
+    return dict(zip(ids, values))
+
+
+# Cached values are wrapped in (_ENVELOPE, soft expiration time, value)
+_ENVELOPE = "djinn:1"
+_refresh_executor = ThreadPoolExecutor(2)
+
+
+def _unwrap(entry):
+    """Returns (found, value, fresh) of a cached entry."""
+    if entry is None:
+        return False, None, False
+    if isinstance(entry, (tuple, list)) and len(entry) == 3 and \
+            entry[0] == _ENVELOPE:
+        return True, entry[2], entry[1] > time.time()
+    # stored by plain manager.set or an older version
+    return True, entry, True
+
+
+def _lease(key, timeout):
+    """Returns True when the lease of key is taken, False when another
+    caller holds it and None when memcache is unavailable."""
+    lease_key = "%s:lease" % key
+    if manager.add(lease_key, 1, timeout, local=False):
+        return True
+    # add fails the same way when the server is down
+    held = manager.get_many([lease_key], local=False) or {}
+    return False if lease_key in held else None
+
+
+def _refresh(key, compute, timeouts):
+    timeout, stale_timeout, negative_timeout = timeouts
+    try:
+        value = compute()
+        if not value:
+            timeout = negative_timeout
+        elif not timeout:
+            timeout = manager.default_timeout
+        if timeout:
+            manager.set(key, (_ENVELOPE, time.time() + timeout, value),
+                        timeout + stale_timeout)
+        return value
+    finally:
+        manager.delete("%s:lease" % key, local=False)
+
+
+def _refresh_in_background(key, compute, timeouts):
+    try:
+        _refresh(key, compute, timeouts)
+    except Exception:
+        logger.exception("Failed to refresh cache %s", key)
+
+
 def delete(key):
     key_ = key
     if options.cache_key_prefix:
@@ -57,61 +269,253 @@ def delete(key):
 
 
 def key_gen(key="", func=None, args_as_key=True, *args, **kw):
-    assert key or func, "key and func must has one"
-    if key:
-        if args_as_key and "%s" in key:
-            args_ = []
-            for arg in args:
-                if PY2:
-                    cls_tup = (basestring, unicode, int, long)
-                else:
-                    cls_tup = (str, bytes, int)
-                if isinstance(arg, cls_tup):
-                    args_.append(arg)
-            key = key % tuple(args_)
-    else:
-        code = hashlib.md5()
-        code.update("%s-%s-%s" % (func.__file__, func.__module__, func.__name__))
-
-        # copy args to avoid sort original args
-        c = list(args[:])
-        # sort c to avoid generate different key when args is the same
-        # but sequence is different
-        c.sort()
-        if PY2:
-            cls_tup = (basestring, unicode)
+    return KeyGenerator(key, func, args_as_key)(*args, **kw)
+
+
+def _digest(data):
+    # md5 beats blake2b and sha1 on such short inputs
+    return hashlib.md5(data).hexdigest()
+
+_KEY_ARG_TYPES = string_types + (binary_type,) + integer_types
+_INVALID_KEY_RE = re.compile(r"[\x00-\x20\x7f]")
+
+
+class KeyGenerator(object):
+
+    """Cache key builder of a function
+
+    With a key, args fill its %s placeholders when args_as_key is True.
+    Otherwise the key is derived from the function name and its arguments,
+    depending on mode:
+
+    * "sorted": a hash ignoring the order of positional arguments
+    * "ordered": a hash of the arguments in order
+    * "readable": "module.function:arg1:arg2:name=value", hashed when too
+      long, not a valid memcache key or when an argument contains ":" (or
+      "=" for positional ones)
+
+    Everything depending only on the function is computed once.
+
+    namespace is a name or a list of names whose current versions are
+    appended to the keys. Names are formatted like key with the leading
+    arguments filling their %s placeholders, or are callables given the
+    arguments.
+    """
+
+    def __init__(self, key=None, func=None, args_as_key=True, mode="sorted",
+                 namespace=None):
+        assert key or func, "key and func must has one"
+        assert mode in ("sorted", "ordered", "readable")
+        self.key = key
+        if namespace and (isinstance(namespace, string_types) or
+                          callable(namespace)):
+            namespace = [namespace]
+        self.namespace = namespace
+        self.format_key = bool(key and args_as_key and "%s" in key)
+        self.mode = mode
+        if not key:
+            self.name = "%s.%s" % (func.__module__, getattr(
+                func, "__qualname__", func.__name__))
+            self.prefix = _digest(utf8(self.name))[:8]
+
+    def __call__(self, *args, **kw):
+        if self.key:
+            key = self.key
+            if self.format_key:
+                key = key % tuple(arg for arg in args
+                                  if isinstance(arg, _KEY_ARG_TYPES))
         else:
-            cls_tup = (str, bytes)
-        c = [utf8(v) if isinstance(v, cls_tup)
-             else str(v) for v in c]
-        code.update("".join(c))
-
-        c = ["%s=%s" % (k, v) for k, v in iteritems(kw)]
-        c.sort()
-        code.update("".join(c))
-
-        key = code.hexdigest()
-        
-        # salt used to reduce the same key
-        salt = func.__name__
-        code.update(salt)
-        key += code.hexdigest()[:3]
-
-    if options.cache_key_prefix:
-        key = "%s:%s" % (options.cache_key_prefix, key)
-
-    return key
-
-
-def setup(servers, timeout=3):
+            parts = [arg if type(arg) is text_type else _to_str(arg)
+                     for arg in args]
+            if self.mode == "sorted":
+                # the same arguments in another order give the same key
+                parts.sort()
+            if kw:
+                parts.extend(sorted("%s=%s" % (k, _to_str(v))
+                                    for k, v in iteritems(kw)))
+
+            if self.mode == "readable":
+                key = ":".join([self.name] + parts)
+                # parts holding the separators would make keys ambiguous,
+                # f("a:b") vs f("a", "b") or f("x=1") vs f(x=1)
+                if len(key) > 200 or _INVALID_KEY_RE.search(key) or \
+                        any(":" in part for part in parts) or \
+                        any("=" in part for part in parts[:len(args)]):
+                    key = "%s:%s" % (self.name[:100], _digest(
+                        "\0".join(parts).encode("utf-8")))
+            else:
+                key = self.prefix + _digest("\0".join(parts).encode("utf-8"))
+
+        if self.namespace:
+            key += namespaces.suffix(self.namespaces(args, kw))
+
+        if options.cache_key_prefix:
+            key = "%s:%s" % (options.cache_key_prefix, key)
+
+        return key
+
+    def namespaces(self, args, kw):
+        """Returns the namespace names of a call."""
+        names = []
+        key_args = None
+        for name in self.namespace:
+            if callable(name):
+                name = name(*args, **kw)
+            elif "%s" in name:
+                if key_args is None:
+                    key_args = tuple(arg for arg in args
+                                     if isinstance(arg, _KEY_ARG_TYPES))
+                name = name % key_args[:name.count("%s")]
+            names.append(name)
+        return names
+
+
+def _to_str(value):
+    if isinstance(value, binary_type):
+        return to_unicode(value)
+    return value if isinstance(value, text_type) else text_type(value)
+
+
+class Versions(object):
+    """Versions of names, stored in memcache under "<prefix>:<name>".
+
+    Bumping a version with invalidate makes every key built with the old
+    one unreachable, and the entries stored under it just expire.
+
+    Versions are read from memcache itself, never from the L1 tier, and
+    kept in-process for ttl seconds, so other processes see a new version
+    within ttl seconds. With a ttl of 0 they are read on every call.
+    """
+
+    # versions must outlive the entries cached under them
+    timeout = 7 * 86400
+    max_entries = 10000
+
+    def __init__(self, prefix, ttl=0):
+        self.prefix = prefix
+        self.ttl = ttl
+        self._versions = {}
+
+    def _key(self, name):
+        key = "%s:%s" % (self.prefix, name)
+        if options.cache_key_prefix:
+            key = "%s:%s" % (options.cache_key_prefix, key)
+        return key
+
+    def _ttl(self):
+        return self.ttl
+
+    def versions(self, names):
+        """Returns the current version of every name."""
+        now = time.time()
+        ttl = self._ttl()
+        versions, missing = {}, []
+        for name in names:
+            entry = self._versions.get(name) if ttl else None
+            if entry and entry[0] > now:
+                versions[name] = entry[1]
+            else:
+                missing.append(name)
+
+        if missing:
+            keys = dict((self._key(name), name) for name in missing)
+            found = manager.get_many(list(keys), local=False) or {}
+            for key, name in iteritems(keys):
+                version = found.get(key)
+                if version is None:
+                    version = _new_version()
+                    if not manager.add(key, version, self.timeout,
+                                       local=False):
+                        # lost a race, or memcache is down and the fresh
+                        # version makes sure nothing stale can be read
+                        version = (manager.get_many([key], local=False)
+                                   or {}).get(key, version)
+                versions[name] = version
+
+            if ttl:
+                if len(self._versions) > self.max_entries:
+                    self._versions.clear()
+                for name in missing:
+                    self._versions[name] = (now + ttl, versions[name])
+
+        return [versions[name] for name in names]
+
+    def invalidate(self, *names):
+        for name in names:
+            self._versions.pop(name, None)
+            key = self._key(name)
+            if manager.incr(key, local=False) is None:
+                manager.add(key, _new_version(), self.timeout, local=False)
+
+
+def _new_version():
+    # time based, so a version evicted from memcache never comes back with
+    # a value some stale entries are still stored under
+    return int(time.time() * 1000)
+
+
+class Namespaces(Versions):
+    """Versions of cache namespaces, stored under "ns:<name>".
+
+    They are kept in-process for cache_namespace_ttl seconds unless ttl is
+    given.
+    """
+
+    def __init__(self, ttl=None):
+        super(Namespaces, self).__init__("ns", ttl)
+
+    def _ttl(self):
+        return options.cache_namespace_ttl if self.ttl is None else self.ttl
+
+    def suffix(self, names):
+        """The key suffix of the current versions of names."""
+        if not names:
+            return ""
+        return ":@" + ".".join(str(v) for v in self.versions(names))
+
+
+namespaces = Namespaces()
+
+
+def invalidate_namespace(*names):
+    """Invalidates every key of the given namespaces with one incr each."""
+    namespaces.invalidate(*names)
+
+
+def setup(servers, timeout=3, local_cache=None, codec=None,
+          consistent_hash=False):
+    """Sets up the global CacheManager.
+
+    consistent_hash spreads keys on a hashring.HashRing of the servers
+    instead of python-memcache's modulo, so adding or losing a server only
+    moves the keys of that server.
+
+    codec enables the codec.Codec serialization and compression of values,
+    a dict with any of serializer ("pickle", "json" or "msgpack"),
+    compression (None, "zlib" or "lz4"), compress_min_size and
+    compress_level. Otherwise values are pickled by python-memcache.
+
+    local_cache enables the in-process L1 tier, a dict with any of:
+
+    * max_entries, max_bytes: size bounds of the LRU (1000, 16MB)
+    * ttl: seconds a value is served from the process (5)
+    * channel, redis: redis pub/sub channel and rstore instance name used
+      to invalidate the copies of the other processes on set/delete
+    """
     global manager
 
     if manager is None:
-        manager = CacheManager(servers, timeout)
+        manager = CacheManager(servers, timeout, local_cache, codec,
+                               consistent_hash)
     return manager
 
 
 def reconnect(func):
+    """Reads errors as cache misses.
+
+    The client is only closed when no circuit breakers are used, otherwise
+    the breaker of the failed server decides when it is tried again.
+    """
     @functools.wraps(func)
     def _wrapper(self, *args, **kwargs):
         try:
@@ -119,61 +523,177 @@ def reconnect(func):
 
             return ret
         except Exception:
-            logger.exception("memcache server closed!")
-            self.close()
+            logger.exception("memcache %s failed", func.__name__)
+            if self.breakers is None:
+                self.close()
 
     return _wrapper
 
 
 class CacheManager(object):
 
-    def __init__(self, servers, timeout=3):
+    def __init__(self, servers, timeout=3, local_cache=None, codec=None,
+                 consistent_hash=False):
         self.servers = servers
         self.default_timeout = int(timeout)
-        self._cache = memcache.Client(self.servers)
+        self.consistent_hash = consistent_hash
+        self.breakers = {} if options.cache_breaker_threshold > 0 else None
+        self._cache = self._client()
+        self.codec = Codec(**codec) if codec else None
+        self.local = None
+        self._invalidator = None
+        self._aio = None
+
+        if local_cache:
+            local_cache = dict(local_cache)
+            channel = local_cache.pop("channel", None)
+            redis_instance = local_cache.pop("redis", "default")
+            if self.codec is not None:
+                local_cache.update(dumps=self.codec.dumps,
+                                   loads=self.codec.loads)
+            self.local = LocalCache(**local_cache)
+            if channel:
+                from . import rstore
+                self._invalidator = Invalidator(
+                    self.local, getattr(rstore.manager, redis_instance),
+                    channel)
 
         logger.debug("Memcached start client %s" % servers)
 
     @property
     def cache(self):
         if self._cache is None:
-            self._cache = memcache.Client(self.servers)
+            self._cache = self._client()
 
         return self._cache
 
-    @reconnect
-    def add(self, key, value, timeout=0):
+    def _client(self):
+        if self.consistent_hash:
+            client = hashring.Client(self.servers)
+        else:
+            client = memcache.Client(self.servers)
+        if self.breakers is not None:
+            breaker.attach(client, self.servers, self.breakers)
+        return client
+
+    @property
+    def aio(self):
+        """An aiocache.AsyncMemcacheClient of the same servers and codec."""
+        if self._aio is None:
+            from .aiocache import AsyncMemcacheClient
+            self._aio = AsyncMemcacheClient(
+                self.servers, self.default_timeout, codec=self.codec,
+                invalidate=self._invalidate,
+                consistent_hash=self.consistent_hash, breakers=self.breakers)
+        return self._aio
+
+    def _invalidate(self, keys):
+        if self.local is not None:
+            for key in keys:
+                self.local.delete(key)
+            if self._invalidator is not None:
+                self._invalidator.publish(keys)
+
+    def _encode(self, value):
+        if self.codec is not None:
+            return self.codec.encode(value)
         if PY2 and isinstance(value, unicode):
-            value = utf8(value)
+            return utf8(value)
+        return value
+
+    def _decode(self, key, val, local=True):
+        """Decodes a value read from memcache and fills the local cache."""
+        local = local and self.local is not None
+        if self.codec is not None:
+            raw, val = val, self.codec.decode(val)
+            if local:
+                self.local.set(key, val, raw if raw is not val else None)
+            return val
 
-        return self.cache.add(key, value,
-                              timeout or self.default_timeout)
+        if PY2 and isinstance(val, basestring):
+            val = utf8(val)
+        if local:
+            self.local.set(key, val)
+        return val
+
+    @reconnect
+    def add(self, key, value, timeout=0, local=True):
+        """Stores value unless key exists.
+
+        local False tells key is never read through the local cache, so
+        there are no copies to invalidate, like for leases and versions.
+        """
+        added = self.cache.add(key, self._encode(value),
+                               timeout or self.default_timeout)
+        if added and local:
+            self._invalidate([key])
+        return added
 
     @reconnect
     def get(self, key, default=None):
+        if self.local is not None:
+            if self._invalidator is not None:
+                self._invalidator.start()
+            found, val = self.local.get(key)
+            if found:
+                return val
+
         val = self.cache.get(key)
         if val is None:
             return default
 
-        if PY2 and isinstance(val, basestring):
-            return utf8(val)
-
-        return val
+        return self._decode(key, val)
 
     @reconnect
     def set(self, key, value, timeout=0):
-        if PY2 and isinstance(value, unicode):
-            value = utf8(value)
-        return self.cache.set(key, value,
+        self._invalidate([key])
+        return self.cache.set(key, self._encode(value),
                               timeout or self.default_timeout)
 
     @reconnect
-    def delete(self, key):
+    def incr(self, key, delta=1, local=True):
+        if local:
+            self._invalidate([key])
+        return self.cache.incr(key, delta)
+
+    @reconnect
+    def delete(self, key, local=True):
+        if local:
+            self._invalidate([key])
         return self.cache.delete(key)
 
     @reconnect
-    def get_many(self, keys):
-        return self.cache.get_multi(keys)
+    def get_many(self, keys, local=True):
+        """Returns a dict of the keys found.
+
+        With local False, values are read from memcache only, neither
+        looked up in nor added to the local cache.
+        """
+        local = local and self.local is not None
+        if local and self._invalidator is not None:
+            self._invalidator.start()
+        if not local and self.codec is None:
+            return self.cache.get_multi(keys)
+
+        values, missing = {}, []
+        for key in keys:
+            found, val = self.local.get(key) if local else (False, None)
+            if found:
+                values[key] = val
+            else:
+                missing.append(key)
+
+        if missing:
+            for key, val in iteritems(self.cache.get_multi(missing)):
+                values[key] = self._decode(key, val, local)
+        return values
+
+    @reconnect
+    def set_many(self, mapping, timeout=0):
+        """Sets all items of mapping, returns the keys that failed."""
+        self._invalidate(list(mapping))
+        mapping = dict((k, self._encode(v)) for k, v in iteritems(mapping))
+        return self.cache.set_multi(mapping, timeout or self.default_timeout)
 
     def close(self, **kwargs):
         try:
@@ -185,12 +705,61 @@ class CacheManager(object):
     def stats(self):
         return self.cache.get_stats()
 
+    def breaker_stats(self):
+        """Circuit breaker state and transition counts by server."""
+        return dict((name, b.stats())
+                    for name, b in iteritems(self.breakers or {}))
+
+    def local_stats(self):
+        """Returns hit/miss/eviction counters of the L1 tier."""
+        return self.local.stats() if self.local is not None else {}
+
     @reconnect
     def flush_all(self):
+        self._invalidate(["*"])
+        if self.local is not None:
+            self.local.clear()
         self.cache.flush_all()
 
 
+def _benchmark():
+    """Compares KeyGenerator to building everything on every call."""
+    import timeit
+
+    def per_call(func, *args, **kw):
+        # previous key_gen: two md5 rounds and the function digest on
+        # every call
+        options.cache_key_prefix
+        code = hashlib.md5()
+        code.update(utf8("%s-%s-%s" % (func.__code__.co_filename,
+                                       func.__module__, func.__name__)))
+        c = sorted(str(v) for v in args)
+        code.update(utf8("".join(c)))
+        c = sorted("%s=%s" % (k, v) for k, v in iteritems(kw))
+        code.update(utf8("".join(c)))
+        key = code.hexdigest()
+        code.update(utf8(func.__name__))
+        return key + code.hexdigest()[:3]
+
+    def get_user(self, user_id, fields=None):
+        pass
+
+    args, kw = (42, "profile"), {"fields": "name"}
+    for name, make_key in (
+            ("per call", lambda: per_call(get_user, *args, **kw)),
+            ("sorted", lambda g=KeyGenerator(None, get_user): g(*args, **kw)),
+            ("ordered", lambda g=KeyGenerator(None, get_user, mode="ordered"):
+                g(*args, **kw)),
+            ("readable", lambda g=KeyGenerator(None, get_user,
+                                               mode="readable"):
+                g(*args, **kw))):
+        best = min(timeit.repeat(make_key, number=100000, repeat=5))
+        print("%-10s %.2f us/key  %s" % (name, best * 10, make_key()))
+
+
 if __name__ == "__main__":
+    _benchmark()
+
     setup(["127.0.0.1"])
 
     @cache()
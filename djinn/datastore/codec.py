@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright(c) 2014 palmhold.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Serialization and compression of cached values
+
+Encoded values start with a magic byte, 0xff, which never starts UTF-8
+text, followed by a header byte holding the serializer in its high nibble
+and the compression in its low nibble. Anything else is a value stored
+before the codec was enabled and is returned untouched, so entries written
+by older versions can still be read during a rollout.
+
+json and msgpack know about dates, times, decimals and bytes, decode maps
+to Row so query results keep their attribute access, and fall back to
+pickle for values they cannot encode. Both turn tuples into lists and
+msgpack/json maps only keep string keys, so values relying on those, or
+on CompactRow and namedtuple column names, should use pickle.
+"""
+
+import base64
+import datetime
+import decimal
+import json
+import zlib
+
+from six import binary_type, integer_types, text_type
+from six.moves import cPickle as pickle
+
+from djinn.db import Row
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import lz4.frame as lz4
+except ImportError:
+    lz4 = None
+
+MAGIC = b"\xff"
+
+PICKLE, JSON, MSGPACK = 1, 2, 3
+SERIALIZERS = {"pickle": PICKLE, "json": JSON, "msgpack": MSGPACK}
+
+NONE, ZLIB, LZ4 = 0, 1, 2
+COMPRESSIONS = {None: NONE, "none": NONE, "zlib": ZLIB, "lz4": LZ4}
+
+_DATETIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+_DATE_FORMAT = "%Y-%m-%d"
+
+
+class Codec(object):
+
+    """Encodes cached values to bytes and back
+
+    Values larger than compress_min_size bytes once serialized are
+    compressed, as long as that makes them smaller. Integers are left
+    alone so memcache incr keeps working on them.
+    """
+
+    def __init__(self, serializer="pickle", compression="zlib",
+                 compress_min_size=1024, compress_level=1):
+        self.serializer = SERIALIZERS[serializer]
+        self.compression = COMPRESSIONS[compression]
+        self.compress_min_size = compress_min_size
+        self.compress_level = compress_level
+
+        if self.serializer == MSGPACK and msgpack is None:
+            raise ImportError("msgpack serializer requires msgpack")
+        if self.compression == LZ4 and lz4 is None:
+            raise ImportError("lz4 compression requires lz4")
+
+    def encode(self, value):
+        """Returns what to store in memcache for value."""
+        if isinstance(value, integer_types) and not isinstance(value, bool):
+            return value
+        return self.dumps(value)
+
+    def decode(self, data):
+        """Returns the value of what memcache returned."""
+        if isinstance(data, binary_type) and data[:1] == MAGIC:
+            return self.loads(data)
+        return data
+
+    def dumps(self, value):
+        serializer = self.serializer
+        try:
+            if serializer == JSON:
+                body = json.dumps(value, default=_json_default,
+                                  separators=(",", ":"))
+                if isinstance(body, text_type):
+                    body = body.encode("utf-8")
+            elif serializer == MSGPACK:
+                body = msgpack.packb(value, default=_msgpack_default,
+                                     use_bin_type=True)
+            else:
+                body = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        except (TypeError, ValueError, OverflowError):
+            serializer = PICKLE
+            body = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+        compression = NONE
+        if self.compression and len(body) >= self.compress_min_size:
+            if self.compression == LZ4:
+                compressed = lz4.compress(body)
+            else:
+                compressed = zlib.compress(body, self.compress_level)
+            if len(compressed) < len(body):
+                body, compression = compressed, self.compression
+
+        return MAGIC + bytearray([serializer << 4 | compression]) + body
+
+    def loads(self, data):
+        header = bytearray(data[1:2])[0]
+        serializer, compression = header >> 4, header & 0x0f
+        body = data[2:]
+
+        if compression == LZ4:
+            body = lz4.decompress(body)
+        elif compression == ZLIB:
+            body = zlib.decompress(body)
+
+        if serializer == JSON:
+            return json.loads(body.decode("utf-8"), object_hook=_json_hook)
+        elif serializer == MSGPACK:
+            return msgpack.unpackb(body, raw=False, object_hook=Row,
+                                   ext_hook=_msgpack_ext_hook,
+                                   strict_map_key=False)
+        return pickle.loads(body)
+
+
+def _dump_special(o):
+    """Returns (tag, text) of the values json and msgpack lack."""
+    if isinstance(o, datetime.datetime):
+        if o.tzinfo is not None:
+            raise TypeError("aware datetimes are pickled")
+        return "dt", o.strftime(_DATETIME_FORMAT)
+    elif isinstance(o, datetime.date):
+        return "d", o.strftime(_DATE_FORMAT)
+    elif isinstance(o, datetime.timedelta):
+        return "td", repr(o.total_seconds())
+    elif isinstance(o, decimal.Decimal):
+        return "dec", str(o)
+    elif isinstance(o, binary_type):
+        return "b", base64.b64encode(o).decode("ascii")
+    raise TypeError("%r is not serializable" % (o,))
+
+
+def _load_special(tag, text):
+    if tag == "dt":
+        return datetime.datetime.strptime(text, _DATETIME_FORMAT)
+    elif tag == "d":
+        return datetime.datetime.strptime(text, _DATE_FORMAT).date()
+    elif tag == "td":
+        return datetime.timedelta(seconds=float(text))
+    elif tag == "dec":
+        return decimal.Decimal(text)
+    elif tag == "b":
+        return base64.b64decode(text)
+    raise ValueError("Unknown tag %s" % tag)
+
+
+def _json_default(o):
+    tag, text = _dump_special(o)
+    return {"$" + tag: text}
+
+
+def _json_hook(d):
+    if len(d) == 1:
+        key = next(iter(d))
+        if key[:1] == "$" and key[1:] in ("dt", "d", "td", "dec", "b"):
+            return _load_special(key[1:], d[key])
+    return Row(d)
+
+
+_EXT_CODES = {"dt": 1, "d": 2, "td": 3, "dec": 4}
+_EXT_TAGS = dict((v, k) for k, v in _EXT_CODES.items())
+
+
+def _msgpack_default(o):
+    # msgpack handles bytes by itself
+    tag, text = _dump_special(o)
+    return msgpack.ExtType(_EXT_CODES[tag], text.encode("ascii"))
+
+
+def _msgpack_ext_hook(code, data):
+    tag = _EXT_TAGS.get(code)
+    if tag is None:
+        return msgpack.ExtType(code, data)
+    return _load_special(tag, data.decode("ascii"))
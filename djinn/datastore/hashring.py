@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright(c) 2014 palmhold.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Ketama consistent hashing.
+
+Every node is placed on a ring of 32 bit points, vnodes points per unit of
+weight, four of them taken from each md5 digest of "<name>-<n>" like
+libketama does. A key belongs to the first point clockwise from its own
+hash, so adding or removing a node only moves the keys of that node.
+"""
+
+import bisect
+import hashlib
+
+import memcache
+from six.moves import range
+from tornado.escape import utf8
+
+
+def _points(digest):
+    return [(digest[3 + i * 4] << 24) | (digest[2 + i * 4] << 16) |
+            (digest[1 + i * 4] << 8) | digest[i * 4]
+            for i in range(4)]
+
+
+def _md5(value):
+    return bytearray(hashlib.md5(utf8(value)).digest())
+
+
+class HashRing(object):
+    """Ring of nodes, given as a list of (name, node, weight) tuples.
+
+    name is what a node is hashed by, so rings built in different
+    processes from the same names agree on where keys go.
+    """
+
+    def __init__(self, nodes, vnodes=160):
+        self.vnodes = vnodes
+        self._nodes = {}
+        self._ring = {}
+        self._points = []
+        for name, node, weight in nodes:
+            self._nodes[name] = (node, weight)
+        self._build()
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def _build(self):
+        ring = {}
+        for name in sorted(self._nodes):
+            node, weight = self._nodes[name]
+            for i in range(max(1, self.vnodes * weight // 4)):
+                for point in _points(_md5("%s-%d" % (name, i))):
+                    ring.setdefault(point, node)
+        self._ring = ring
+        self._points = sorted(ring)
+
+    def add_node(self, name, node, weight=1):
+        self._nodes[name] = (node, weight)
+        self._build()
+
+    def remove_node(self, name):
+        self._nodes.pop(name, None)
+        self._build()
+
+    def hash(self, key):
+        return _points(_md5(key))[0]
+
+    def get_node(self, key):
+        """Returns the node of key, None if the ring is empty."""
+        for node in self.iter_nodes(key):
+            return node
+        return None
+
+    def iter_nodes(self, key, point=None):
+        """Yields each node once, clockwise from the point of key."""
+        if not self._points:
+            return
+        if point is None:
+            point = self.hash(key)
+        start = bisect.bisect(self._points, point)
+        seen = set()
+        for i in range(len(self._points)):
+            node = self._ring[self._points[(start + i) % len(self._points)]]
+            if id(node) not in seen:
+                seen.add(id(node))
+                yield node
+                if len(seen) == len(self._nodes):
+                    return
+
+
+def host_name(host):
+    """The ring name of a python-memcache host, "host:port" or the path."""
+    if isinstance(host.address, tuple):
+        return "%s:%d" % host.address
+    return host.address
+
+
+class Client(memcache.Client):
+    """python-memcache client placing keys on a HashRing of its servers.
+
+    When the server of a key is down, the key goes to the next live one
+    clockwise, so only the keys of that server move while it is out.
+    """
+
+    vnodes = 160
+
+    def _init_buckets(self):
+        self.buckets = list(self.servers)
+        self.ring = HashRing([(host_name(s), s, s.weight)
+                              for s in self.servers], self.vnodes)
+
+    def _get_server(self, key):
+        point = None
+        if isinstance(key, tuple):
+            point, key = key
+            point &= 0xffffffff
+        for server in self.ring.iter_nodes(key, point):
+            if server.connect():
+                return server, key
+        return None, None
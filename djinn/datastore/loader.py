@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright(c) 2014 palmhold.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Batched, memoized key lookups
+
+A DataLoader turns many lookups of single keys into one batched lookup,
+which avoids the N+1 queries of loops like::
+
+    for item in items:
+        item.user = db.get("SELECT * FROM users WHERE id=%s", item.user_id)
+
+Handlers get request scoped loaders from BaseHandler.loader()::
+
+    users = self.loader("users", lambda: query_loader(
+        manager.main.slave, "SELECT * FROM users WHERE id IN %s",
+        cache_key="user:%s"))
+    users.prime(item.user_id for item in items)
+    for item in items:
+        item.user = users.load(item.user_id)
+
+Coroutines can use load_async() instead, lookups issued during the same
+IOLoop iteration are batched together.
+"""
+
+from tornado import gen
+from tornado.concurrent import Future, is_future
+from tornado.ioloop import IOLoop
+
+
+class DataLoader(object):
+
+    """Batches key lookups and memoizes their results
+
+    batch_fn(keys) returns either a dict mapping keys to values or a list
+    of values ordered like keys, or a Future resolving to one of those for
+    load_async(). Keys it does not return are memoized as None.
+    """
+
+    def __init__(self, batch_fn, max_batch_size=500):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self._values = {}
+        self._pending = []
+        self._pending_keys = set()
+        self._futures = {}
+        self._scheduled = False
+
+    def prime(self, keys):
+        """Queues keys to be fetched by the next batch."""
+        for key in keys:
+            if key not in self._values and key not in self._pending_keys:
+                self._pending.append(key)
+                self._pending_keys.add(key)
+
+    def load(self, key):
+        """Returns the value of key, fetching it with all queued keys."""
+        if key not in self._values:
+            self.prime((key,))
+            self.dispatch()
+        return self._values.get(key)
+
+    def load_many(self, keys):
+        """Returns the values of keys in order, in one batch."""
+        keys = list(keys)
+        self.prime(keys)
+        if self._pending:
+            self.dispatch()
+        return [self._values.get(key) for key in keys]
+
+    def dispatch(self):
+        """Fetches all queued keys."""
+        keys = self._take_pending()
+        try:
+            for batch in self._batches(keys):
+                self._store(batch, self.batch_fn(batch))
+        except Exception as e:
+            self._fail(keys, e)
+            raise
+
+    def load_async(self, key):
+        """Returns a Future of the value of key.
+
+        Keys requested during the same IOLoop iteration are fetched in
+        one batch.
+        """
+        if key in self._values:
+            future = Future()
+            future.set_result(self._values[key])
+            return future
+
+        future = self._futures.get(key)
+        if future is None:
+            future = self._futures[key] = Future()
+            self.prime((key,))
+            if not self._scheduled:
+                self._scheduled = True
+                IOLoop.current().add_callback(self._dispatch_async)
+        return future
+
+    def load_many_async(self, keys):
+        return gen.multi([self.load_async(key) for key in keys])
+
+    @gen.coroutine
+    def _dispatch_async(self):
+        self._scheduled = False
+        keys = self._take_pending()
+        try:
+            for batch in self._batches(keys):
+                values = self.batch_fn(batch)
+                if is_future(values):
+                    values = yield values
+                self._store(batch, values)
+        except Exception as e:
+            self._fail(keys, e)
+
+    def clear(self, key=None):
+        """Forgets the memoized value of key, or of all keys."""
+        if key is None:
+            self._values.clear()
+        else:
+            self._values.pop(key, None)
+
+    def _take_pending(self):
+        keys = self._pending
+        self._pending = []
+        self._pending_keys = set()
+        return keys
+
+    def _batches(self, keys):
+        for i in range(0, len(keys), self.max_batch_size):
+            yield keys[i:i + self.max_batch_size]
+
+    def _store(self, keys, values):
+        if not isinstance(values, dict):
+            values = dict(zip(keys, values))
+        for key in keys:
+            value = values.get(key)
+            self._values[key] = value
+            future = self._futures.pop(key, None)
+            if future is not None:
+                future.set_result(value)
+
+    def _fail(self, keys, e):
+        for key in keys:
+            future = self._futures.pop(key, None)
+            if future is not None and not future.done():
+                future.set_exception(e)
+
+
+def query_loader(db, query, column="id", many=False, cache_key=None,
+                 timeout=3600, max_batch_size=500):
+    """Returns a DataLoader fetching rows with one query per batch.
+
+    query takes the tuple of keys as its single parameter, e.g.
+    ``SELECT * FROM users WHERE id IN %s``, and rows are matched to keys
+    by their column value. With many, every key loads the list of its rows.
+
+    With cache_key, a key pattern like ``user:%s``, rows are first read
+    from memcache with a single get_many and the ones fetched from db are
+    written back with a single set_many, like cache_many does.
+    """
+    def fetch(keys):
+        rows = db.query(query, tuple(keys))
+        if not many:
+            return dict((row[column], row) for row in rows)
+        values = dict((key, []) for key in keys)
+        for row in rows:
+            values.setdefault(row[column], []).append(row)
+        return values
+
+    if cache_key is None:
+        return DataLoader(fetch, max_batch_size)
+
+    from . import cache
+
+    def fetch_cached(keys):
+        if cache.manager is None:
+            return fetch(keys)
+
+        return cache.fetch_many(
+            dict((key, cache.key_gen(cache_key, None, True, key))
+                 for key in keys), fetch, timeout)
+
+    return DataLoader(fetch_cached, max_batch_size)
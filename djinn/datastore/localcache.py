@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright(c) 2014 palmhold.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""In-process LRU cache used as L1 tier in front of memcache"""
+
+import collections
+import logging
+import os
+import threading
+import time
+import uuid
+
+from six.moves import cPickle as pickle
+from tornado.escape import to_unicode
+
+logger = logging.getLogger(__name__)
+
+
+class LocalCache(object):
+
+    """A bounded, thread-safe LRU cache with a short TTL
+
+    Values are kept serialized, pickled unless other dumps/loads functions
+    are given, so callers mutating what they got never alter the cached
+    copy, and their size is known exactly. Both the number of entries and
+    their total size in bytes are bounded.
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=16 * 1024 * 1024, ttl=5,
+                 dumps=None, loads=None):
+        self.max_entries = int(max_entries)
+        self.max_bytes = int(max_bytes)
+        self.ttl = float(ttl)
+        self.dumps = dumps or _pickle_dumps
+        self.loads = loads or pickle.loads
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0,
+                       "expirations": 0, "invalidations": 0}
+
+    def get(self, key):
+        """Returns (found, value)."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self._stats["misses"] += 1
+                return False, None
+            if entry[0] < time.time():
+                self._bytes -= len(entry[1])
+                self._stats["expirations"] += 1
+                self._stats["misses"] += 1
+                return False, None
+            # most recently used entries sit at the right end
+            self._entries[key] = entry
+            self._stats["hits"] += 1
+        return True, self.loads(entry[1])
+
+    def set(self, key, value, blob=None):
+        """Caches value, blob is its serialized form when already known."""
+        if blob is None:
+            blob = self.dumps(value)
+        if len(blob) > self.max_bytes:
+            self.delete(key)
+            return
+
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old[1])
+            self._entries[key] = (time.time() + self.ttl, blob)
+            self._bytes += len(blob)
+            while len(self._entries) > self.max_entries or \
+                    self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted[1])
+                self._stats["evictions"] += 1
+
+    def delete(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._bytes -= len(entry[1])
+                self._stats["invalidations"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._stats["invalidations"] += len(self._entries)
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update(entries=len(self._entries), bytes=self._bytes)
+        return stats
+
+
+def _pickle_dumps(value):
+    return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+
+class Invalidator(object):
+
+    """Carries local cache invalidations to other processes over a redis
+    pub/sub channel.
+
+    Keys are gathered for batch_interval seconds and published in one
+    message by a thread of their own, so writes never wait for redis.
+
+    The listener and publisher threads are started by the first start()
+    of each process, since threads do not survive a fork and processes
+    forked after the cache was set up need their own.
+    """
+
+    batch_interval = 0.05
+
+    def __init__(self, local_cache, redis, channel):
+        self.local_cache = local_cache
+        self.redis = redis
+        self.channel = channel
+        self.token = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self._pubsub = None
+        self._listener = None
+
+    def start(self):
+        """Subscribes to the channel once per process."""
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._start_lock:
+            if self._pid == pid:
+                return
+            # messages published by this process are ignored
+            self.token = "%s-%s" % (pid, uuid.uuid4().hex[:8])
+            self._pending = set()
+            self._lock = threading.Lock()
+            self._wake = threading.Event()
+            self._closed = False
+            try:
+                self._pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                self._pubsub.subscribe(**{self.channel: self._on_message})
+                self._listener = self._pubsub.run_in_thread(sleep_time=1,
+                                                            daemon=True)
+            except Exception:
+                logger.exception("Failed to subscribe to cache invalidations")
+            publisher = threading.Thread(target=self._publish_loop,
+                                         name="djinn-cache-invalidator")
+            publisher.daemon = True
+            publisher.start()
+            self._pid = pid
+
+    def publish(self, keys):
+        self.start()
+        with self._lock:
+            self._pending.update(keys)
+            self._wake.set()
+
+    def _publish_loop(self):
+        while not self._closed:
+            self._wake.wait()
+            time.sleep(self.batch_interval)
+            with self._lock:
+                keys, self._pending = self._pending, set()
+                self._wake.clear()
+            if not keys:
+                continue
+            try:
+                self.redis.publish(self.channel, "%s %s" % (
+                    self.token, " ".join(keys)))
+            except Exception:
+                logger.exception("Failed to publish cache invalidation")
+
+    def _on_message(self, message):
+        token, _, keys = to_unicode(message["data"]).partition(" ")
+        if token == self.token:
+            return
+        for key in keys.split(" "):
+            if key == "*":
+                self.local_cache.clear()
+            else:
+                self.local_cache.delete(key)
+
+    def close(self):
+        if self._pid != os.getpid():
+            return
+        self._closed = True
+        self._wake.set()
+        if self._listener is not None:
+            self._listener.stop()
@@ -14,15 +14,27 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import binascii
+import bisect
+import collections
+import contextlib
+import threading
 import time
 import logging
+import os
 
-from djinn.db import Connection as BaseConnection
-from six import iteritems, PY2
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from djinn.db import (AsyncConnection, Connection as BaseConnection,
+                      OperationalError, ProgrammingError)
+from pymysql.constants import SERVER_STATUS
+from six import binary_type, iteritems, text_type, PY2
 from tornado.options import options, define
 from tornado import escape
 
 from ..errors import DatastoreError
+from . import querycache, querystats
+from .querystats import Statement
 
 define("log_db_query", True, bool, "whether log db query statements")
 
@@ -39,11 +51,35 @@ def setup(datastore_pool):
 
 
 class MysqlManager(object):
+
+    """Mysql datastore instances
+
+    datastore_pool maps instance names to a list of DSN option dicts, the
+    master followed by its replicas, or for sharded instances to a dict of
+    ShardedConnection options::
+
+        datastore_pool = {
+            "main": [{"host": "db1:3306", ...}, {"host": "db2:3306", ...}],
+            "users": {"shards": [[{"host": "u1:3306", ...}],
+                                 [{"host": "u2:3306", ...}]],
+                      "shard_by": "hash"},
+        }
+    """
+
     _datastore_pool = {}
 
     def __init__(self, datastore_pool):
         for k, v in iteritems(datastore_pool):
-            MysqlManager._datastore_pool[k] = MysqlMSConnection(v[0])
+            if isinstance(v, dict):
+                conn = ShardedConnection(v)
+            else:
+                conn = MysqlMSConnection(v[0], v[1:])
+            MysqlManager._datastore_pool[k] = conn
+
+    def stats(self):
+        """Returns pool statistics of every datastore instance."""
+        return dict((k, v.stats())
+                    for k, v in iteritems(self._datastore_pool))
 
     def __getattr__(self, instance):
         r = self._datastore_pool.get(instance, None)
@@ -60,13 +96,16 @@ class MysqlMSConnection(object):
 
     Manage datastore connection instances.
 
-    """
+    The first DSN of a datastore_pool entry is the master, the following
+    ones are replicas serving reads made through ``slave``.
 
-    def __init__(self, master):
-        self.master = Connection(master)
+    """
 
-        # Kept for compatibility
-        self._slave_conns = []
+    def __init__(self, master, slaves=None):
+        self.master = ConnectionPool(master)
+        self._slave_conns = [Replica(v) for v in slaves or []]
+        self._replica_set = (ReplicaSet(self.master, self._slave_conns)
+                             if self._slave_conns else None)
 
     @property
     def query(self):
@@ -92,9 +131,565 @@ class MysqlMSConnection(object):
     def update(self):
         return self.master.update
 
+    @property
+    def bulk_insert(self):
+        return self.master.bulk_insert
+
+    @property
+    def iter_batches(self):
+        return self.master.iter_batches
+
     @property
     def slave(self):
-        return self.master
+        return self._replica_set or self.master
+
+    @property
+    def aio(self):
+        """Awaitable query/get/execute... of the master."""
+        return self.master.aio
+
+    def cached(self, timeout=300):
+        """Cached query/get of the master, see querycache.QueryCache."""
+        return self.master.cached(timeout)
+
+    def stats(self):
+        stats = {"master": self.master.stats()}
+        if self._slave_conns:
+            stats["slaves"] = [r.stats() for r in self._slave_conns]
+        return stats
+
+
+class ShardedConnection(object):
+
+    """Mysql connections of a sharded datastore
+
+    ``shards`` lists the master and replica DSNs of every shard, like
+    unsharded datastore_pool entries. ``shard_by`` picks the shard of a
+    key:
+
+    * "hash" (default): crc32 of the key modulo the number of shards
+    * "range": ``ranges`` lists the exclusive upper bound of every shard
+      but the last, e.g. [1000000, 2000000] for 3 shards
+    * a callable shard_by(key, number_of_shards) returning the index
+
+    ::
+
+        manager.users.shard(user_id).query("SELECT ...", user_id)
+        rows = manager.users.query_all("SELECT * FROM users WHERE vip = 1")
+    """
+
+    def __init__(self, config):
+        self.shards = [MysqlMSConnection(v[0], v[1:])
+                       for v in config["shards"]]
+        if not self.shards:
+            raise DatastoreError("Sharded mysql instance without shards")
+
+        shard_by = config.get("shard_by", "hash")
+        if callable(shard_by):
+            self._locate = lambda key: shard_by(key, len(self.shards))
+        elif shard_by == "hash":
+            self._locate = self._hash
+        elif shard_by == "range":
+            self._bounds = list(config["ranges"])
+            if len(self._bounds) != len(self.shards) - 1 or \
+                    self._bounds != sorted(self._bounds):
+                raise DatastoreError("Sharded mysql instance needs %s sorted "
+                                     "range bounds" % (len(self.shards) - 1))
+            self._locate = self._range
+        else:
+            raise DatastoreError("Unknown shard_by %r" % shard_by)
+
+        self._executor = ThreadPoolExecutor(len(self.shards))
+
+    def _hash(self, key):
+        if not isinstance(key, (binary_type, text_type)):
+            key = str(key)
+        code = binascii.crc32(escape.utf8(key))
+        return (code & 0xffffffff) % len(self.shards)
+
+    def _range(self, key):
+        return bisect.bisect_right(self._bounds, key)
+
+    def shard_index(self, key):
+        return self._locate(key)
+
+    def shard(self, key):
+        """Returns the MysqlMSConnection of the shard holding key."""
+        return self.shards[self._locate(key)]
+
+    def group(self, keys):
+        """Returns {shard index: keys} for a list of keys, handy to batch
+        lookups per shard."""
+        groups = {}
+        for key in keys:
+            groups.setdefault(self._locate(key), []).append(key)
+        return groups
+
+    def scatter(self, func):
+        """Calls func(shard) on every shard in parallel.
+
+        Returns the results in shard order, the exception of the first
+        failing shard in shard order is raised once all shards are done.
+        """
+        futures = [self._executor.submit(func, shard)
+                   for shard in self.shards]
+        wait(futures)
+        return [f.result() for f in futures]
+
+    def query_all(self, query, *parameters, **kwparameters):
+        """Runs a query on the master of every shard in parallel and
+        returns all the rows, in shard order."""
+        rows = []
+        for result in self.scatter(lambda shard: shard.query(
+                query, *parameters, **kwparameters)):
+            rows.extend(result)
+        return rows
+
+    def execute_all(self, query, *parameters, **kwparameters):
+        """Runs a statement on every shard in parallel, returns the total
+        rowcount."""
+        return sum(self.scatter(lambda shard: shard.master.execute_rowcount(
+            query, *parameters, **kwparameters)))
+
+    def stats(self):
+        return [shard.stats() for shard in self.shards]
+
+
+class Replica(object):
+
+    """A replica in a ReplicaSet
+
+    Besides the connection and pool options, the options dict accepts:
+
+    * weight: share of the reads routed to this replica (1)
+    * max_replication_lag: seconds behind master after which the replica
+      is taken out of rotation (30)
+    * health_check_interval: seconds between health checks (5)
+    """
+
+    def __init__(self, options):
+        options = dict(options)
+        self.weight = max(int(options.pop("weight", 1)), 1)
+        self.max_lag = float(options.pop("max_replication_lag", 30))
+        self.check_interval = float(options.pop("health_check_interval", 5))
+        self.pool = ConnectionPool(options)
+        self.host = self.pool.host
+
+        self.healthy = True
+        self.lag = None
+        # smooth weighted round-robin state, guarded by the ReplicaSet lock
+        self.current_weight = 0
+        self._next_check = 0
+        self._check_lock = threading.Lock()
+        self._status_query = "SHOW REPLICA STATUS"
+
+    def check(self, force=False):
+        """Runs a health check if it is due.
+
+        Called by the health check thread of the ReplicaSet, which keeps
+        the checks off the request path.
+        """
+        now = time.time()
+        if not force and now < self._next_check:
+            return
+        if not self._check_lock.acquire(False):
+            return
+        try:
+            self._next_check = now + self.check_interval
+            lag = self._replication_lag()
+            healthy = lag is not None and lag <= self.max_lag
+            if healthy != self.healthy:
+                logger.warning("Mysql replica %s is %s (lag: %s)", self.host,
+                               "back in rotation" if healthy
+                               else "out of rotation", lag)
+            self.lag = lag
+            self.healthy = healthy
+        finally:
+            self._check_lock.release()
+
+    def _replication_lag(self):
+        try:
+            status = self._replica_status()
+        except Exception as e:
+            logger.warning("Mysql replica %s health check failed: %s",
+                           self.host, e)
+            return None
+
+        if status is None:
+            # not replicating from anywhere, e.g. a development setup
+            # pointing replicas at the master
+            return 0
+        lag = status.get("Seconds_Behind_Source",
+                         status.get("Seconds_Behind_Master"))
+        # NULL lag means replication is stopped
+        return None if lag is None else float(lag)
+
+    def _replica_status(self):
+        try:
+            return self.pool.get(self._status_query)
+        except ProgrammingError:
+            # mysql < 8.0.22 only knows the legacy statement
+            if self._status_query == "SHOW SLAVE STATUS":
+                raise
+            self._status_query = "SHOW SLAVE STATUS"
+            return self.pool.get(self._status_query)
+
+    def mark_down(self):
+        self.healthy = False
+        self._next_check = time.time() + self.check_interval
+
+    def stats(self):
+        stats = self.pool.stats()
+        stats.update(host=self.host, healthy=self.healthy, lag=self.lag,
+                     weight=self.weight)
+        return stats
+
+
+class ReplicaSet(object):
+
+    """Routes reads across replicas
+
+    Healthy replicas are picked by smooth weighted round-robin. Reads fall
+    back to the master when no replica is healthy or when the chosen one
+    fails with a connection error.
+
+    Replication lag is checked by a daemon thread started on the first
+    read of each process, reads only look at the last known state.
+
+    Anything but reads is delegated to the master so code written against
+    the former ``slave`` alias of the master keeps working.
+    """
+
+    def __init__(self, master, replicas):
+        self.master = master
+        self.replicas = replicas
+        self._lock = threading.Lock()
+        self._aio = None
+        self._checker_pid = None
+        self._stopped = threading.Event()
+
+    def __getattr__(self, name):
+        return getattr(self.master, name)
+
+    def _start_checker(self):
+        # Threads do not survive a fork, so every process starts its own
+        pid = os.getpid()
+        if self._checker_pid == pid:
+            return
+        with self._lock:
+            if self._checker_pid == pid:
+                return
+            self._checker_pid = pid
+            thread = threading.Thread(target=self._check_loop,
+                                      name="djinn-replica-check")
+            thread.daemon = True
+            thread.start()
+
+    def _check_loop(self):
+        interval = min(r.check_interval for r in self.replicas)
+        while not self._stopped.is_set():
+            for replica in self.replicas:
+                try:
+                    replica.check()
+                except Exception:
+                    logger.exception("Mysql replica %s health check error",
+                                     replica.host)
+            self._stopped.wait(interval)
+
+    def close(self):
+        """Stops the health check thread."""
+        self._stopped.set()
+
+    @property
+    def aio(self):
+        if self._aio is None:
+            self._aio = AsyncConnection(
+                self, max_workers=sum(r.pool.max_size for r in self.replicas))
+        return self._aio
+
+    def cached(self, timeout=300):
+        return querycache.QueryCache(self, self.master.database, timeout)
+
+    def choose(self):
+        """Returns the next replica pool to read from, or the master."""
+        self._start_checker()
+
+        with self._lock:
+            best, total = None, 0
+            for replica in self.replicas:
+                if not replica.healthy:
+                    continue
+                replica.current_weight += replica.weight
+                total += replica.weight
+                if best is None or \
+                        replica.current_weight > best.current_weight:
+                    best = replica
+            if best is None:
+                return None
+            best.current_weight -= total
+            return best
+
+    def _read(self, name, *args, **kwargs):
+        replica = self.choose()
+        if replica is None:
+            return getattr(self.master, name)(*args, **kwargs)
+
+        try:
+            return getattr(replica.pool, name)(*args, **kwargs)
+        except OperationalError:
+            logger.exception("Mysql replica %s failed, reading from master",
+                             replica.host)
+            replica.mark_down()
+            return getattr(self.master, name)(*args, **kwargs)
+
+    def query(self, query, *parameters, **kwparameters):
+        return self._read("query", query, *parameters, **kwparameters)
+
+    def get(self, query, *parameters, **kwparameters):
+        return self._read("get", query, *parameters, **kwparameters)
+
+    def iter(self, query, *parameters, **kwparameters):
+        return self._target().iter(query, *parameters, **kwparameters)
+
+    def iter_batches(self, query, *parameters, **kwparameters):
+        return self._target().iter_batches(query, *parameters, **kwparameters)
+
+    def _target(self):
+        replica = self.choose()
+        return replica.pool if replica is not None else self.master
+
+
+def _pooled(name):
+    def _wrapper(self, *args, **kwargs):
+        with self.connection() as conn:
+            return getattr(conn, name)(*args, **kwargs)
+
+    _wrapper.__name__ = name
+    return _wrapper
+
+
+class ConnectionPool(object):
+
+    """A bounded, thread-safe pool of mysql connections.
+
+    Besides the usual connection options, the options dict accepts:
+
+    * min_connections: connections opened up front and kept open (1)
+    * max_connections: upper bound of open connections (10)
+    * pool_timeout: seconds to wait for a free connection (10)
+    * idle_timeout: seconds after which surplus idle connections above
+      min_connections are closed (600)
+
+    Connections idle for longer than max_idle_time are reopened when they
+    are checked out, because mysql drops idle clients silently.
+
+    query/get/execute and friends check a connection out for the duration
+    of the call only, so several statements that must share a session
+    (e.g. a transaction) should use ``with pool.connection() as conn:``.
+    """
+
+    reap_interval = 30
+
+    def __init__(self, options):
+        options = dict(options)
+        self.min_size = int(options.pop("min_connections", 1))
+        self.max_size = max(int(options.pop("max_connections", 10)),
+                            self.min_size, 1)
+        self.timeout = float(options.pop("pool_timeout", 10))
+        self.idle_timeout = float(options.pop("idle_timeout", 600))
+        self.max_idle_time = float(options.get("max_idle_time", 7 * 3600))
+        self.options = options
+        self.host = options.get("host", "localhost:3306")
+        self.database = options.get("database", "test")
+
+        self._idle = collections.deque()
+        self._size = 0
+        self._in_use = 0
+        self._cond = threading.Condition(threading.Lock())
+        self._last_reap = time.time()
+        self._aio = None
+        self._stats = {"created": 0, "closed": 0, "checkouts": 0,
+                       "waits": 0, "timeouts": 0}
+
+        for _ in range(self.min_size):
+            with self._cond:
+                self._size += 1
+            self._idle.append(self._create())
+
+    def _create(self):
+        conn = Connection(self.options)
+        with self._cond:
+            self._stats["created"] += 1
+        return conn
+
+    def _discard(self, conn):
+        conn.close()
+        with self._cond:
+            self._stats["closed"] += 1
+
+    def checkout(self, timeout=None):
+        """Takes a connection out of the pool.
+
+        Waits up to timeout seconds (pool_timeout by default) for another
+        thread to return one when max_connections are already in use, then
+        raises DatastoreError.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time.time() + timeout
+        conn = None
+        with self._cond:
+            self._stats["checkouts"] += 1
+            waited = False
+            while True:
+                if self._idle:
+                    # LIFO keeps the hot connections busy and lets the
+                    # surplus ones go idle long enough to be reaped.
+                    conn = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    break
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self._stats["timeouts"] += 1
+                    raise DatastoreError("Mysql pool on %s exhausted, no "
+                                         "connection available in %s seconds"
+                                         % (self.host, timeout))
+                if not waited:
+                    self._stats["waits"] += 1
+                    waited = True
+                self._cond.wait(remaining)
+            self._in_use += 1
+
+        if conn is None:
+            try:
+                conn = self._create()
+            except Exception:
+                with self._cond:
+                    self._size -= 1
+                    self._in_use -= 1
+                    self._cond.notify()
+                raise
+        elif time.time() - conn._last_use_time > self.max_idle_time:
+            # Reopened lazily by _ensure_connected
+            conn.close()
+
+        return conn
+
+    def checkin(self, conn):
+        """Returns a connection checked out by checkout() to the pool.
+
+        A transaction left open, e.g. by an error raised before COMMIT, is
+        rolled back first so the next user does not write inside it. The
+        connection is closed when that fails.
+        """
+        db = conn._db
+        if db is not None and \
+                db.server_status & SERVER_STATUS.SERVER_STATUS_IN_TRANS:
+            logger.warning("Rolling back a transaction left open on %s",
+                           self.host)
+            try:
+                db.rollback()
+            except Exception:
+                logger.exception("Mysql rollback failed on %s", self.host)
+                try:
+                    conn.close()
+                except Exception:
+                    conn._db = None
+
+        with self._cond:
+            self._in_use -= 1
+            self._idle.append(conn)
+            self._cond.notify()
+        self.reap()
+
+    @property
+    def aio(self):
+        """An AsyncConnection keeping up to max_connections queries of
+        this pool in flight."""
+        if self._aio is None:
+            self._aio = AsyncConnection(self, max_workers=self.max_size)
+        return self._aio
+
+    def cached(self, timeout=300):
+        """A QueryCache reading through this pool."""
+        return querycache.QueryCache(self, self.database, timeout)
+
+    @contextlib.contextmanager
+    def connection(self, timeout=None):
+        conn = self.checkout(timeout)
+        try:
+            yield conn
+        finally:
+            self.checkin(conn)
+
+    def reap(self, force=False):
+        """Closes surplus connections that have been idle for too long.
+
+        Stale connections kept for min_connections are reopened at
+        checkout instead. Runs at most once every reap_interval seconds unless force is True.
+        """
+        now = time.time()
+        if not force and now - self._last_reap < self.reap_interval:
+            return
+
+        surplus = []
+        with self._cond:
+            self._last_reap = now
+            # the least recently used connections sit at the left end
+            while (self._idle and self._size > self.min_size and
+                   now - self._idle[0]._last_use_time > self.idle_timeout):
+                surplus.append(self._idle.popleft())
+                self._size -= 1
+
+        for conn in surplus:
+            self._discard(conn)
+
+    def close(self):
+        """Closes all idle connections."""
+        with self._cond:
+            conns = list(self._idle)
+            self._idle.clear()
+            self._size -= len(conns)
+        for conn in conns:
+            self._discard(conn)
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update(size=self._size, idle=len(self._idle),
+                         in_use=self._in_use, min_size=self.min_size,
+                         max_size=self.max_size)
+        return stats
+
+    def iter(self, query, *parameters, **kwparameters):
+        with self.connection() as conn:
+            for row in conn.iter(query, *parameters, **kwparameters):
+                yield row
+
+    def iter_batches(self, query, *parameters, **kwparameters):
+        """Streams row batches over a connection of its own, which does not
+        count against max_connections."""
+        return Connection._stream(lambda: Connection(self.options),
+                                  query, parameters, kwparameters)
+
+    query = _pooled("query")
+    get = _pooled("get")
+    execute = _pooled("execute")
+    execute_lastrowid = _pooled("execute_lastrowid")
+    execute_rowcount = _pooled("execute_rowcount")
+    executemany = _pooled("executemany")
+    executemany_lastrowid = _pooled("executemany_lastrowid")
+    executemany_rowcount = _pooled("executemany_rowcount")
+    bulk_insert = _pooled("bulk_insert")
+
+    update = delete = execute_rowcount
+    updatemany = executemany_rowcount
+
+    insert = execute_lastrowid
+    insertmany = executemany_lastrowid
 
 
 class Connection(BaseConnection):
@@ -114,8 +709,15 @@ class Connection(BaseConnection):
 
         super(Connection, self).__init__(**default_options)
 
+    def _ensure_connected(self):
+        # Idle connections are reaped by ConnectionPool, just reopen the
+        # ones closed by the reaper or after an error here.
+        if self._db is None:
+            self.reconnect()
+        self._last_use_time = time.time()
+
     def _execute(self, cursor, query, parameters, kwparameters):
-        # Override default _execute to log executing info when log_query is on
+        # Override default _execute to account and log executing info
         parameters_ = []
         for parameter in parameters:
             if isinstance(parameter, unicode if PY2 else str):
@@ -123,19 +725,37 @@ class Connection(BaseConnection):
             parameters_.append(parameter)
         parameters = tuple(parameters_)
 
-        if options.log_db_query:
-            sql = query % parameters
-            try:
-                start = time.time()
-                r = super(Connection, self)._execute(cursor, query, parameters,
-                                                     kwparameters)
-                elapse = time.time() - start
-                logger.debug("SQL executing elapse %s seconds on %s: %s",
-                             elapse, self.host, sql)
-
-                return r
-            except Exception as e:
-                logger.error("SQL: %s", sql)
-                raise e
-        else:
-            return super(Connection, self)._execute(cursor, query, parameters, kwparameters)
+        start = time.time()
+        try:
+            r = super(Connection, self)._execute(cursor, query, parameters,
+                                                 kwparameters)
+        except Exception:
+            if options.log_db_query:
+                logger.error("SQL: %s",
+                             Statement(query, kwparameters or parameters))
+            raise
+
+        self._executed(query, kwparameters or parameters,
+                       time.time() - start, cursor.rowcount)
+        return r
+
+    def _executemany(self, cursor, query, parameters):
+        start = time.time()
+        try:
+            r = super(Connection, self)._executemany(cursor, query, parameters)
+        except Exception:
+            if options.log_db_query:
+                logger.error("SQL: %s", Statement(query, parameters))
+            raise
+
+        self._executed(query, parameters, time.time() - start,
+                       cursor.rowcount)
+        return r
+
+    def _executed(self, query, parameters, elapse, rowcount):
+        querystats.record(self.host, query, parameters, elapse, rowcount)
+        if options.db_query_cache:
+            querycache.invalidate_statement(self.database, query)
+        if options.log_db_query and logger.isEnabledFor(logging.DEBUG):
+            logger.debug("SQL executing elapse %s seconds on %s: %s",
+                         elapse, self.host, Statement(query, parameters))
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright(c) 2014 palmhold.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Table tagged query result cache
+
+Cached results are stored in memcache under a key derived from the
+statement, its parameters and the current version of every table it reads.
+Writes going through a mysql Connection bump the version of the tables they
+touch, so stale results are never read again and simply expire, without
+any explicit delete::
+
+    rows = manager.main.cached(600).query(
+        "SELECT * FROM users u JOIN teams t ON u.team_id = t.id "
+        "WHERE t.id = %s", team_id)
+
+Both reads and invalidation are enabled by the db_query_cache option, which
+must be on in every process writing to the cached tables. Versions are
+bumped when a write executes, not when its transaction commits, and results
+read from a lagging replica may be cached under the new version, so keep
+timeouts short for tables written inside transactions or read from
+replicas.
+"""
+
+import hashlib
+import logging
+import re
+
+from tornado.escape import utf8
+from tornado.options import options, define
+
+from .querystats import fingerprint
+
+define("db_query_cache", False, bool,
+       "whether query results can be cached and writes invalidate them")
+
+logger = logging.getLogger(__name__)
+
+_NAME = r"(?:`[^`]+`|\w+)(?:\s*\.\s*(?:`[^`]+`|\w+))?"
+_MODIFIERS = r"(?:(?:LOW_PRIORITY|HIGH_PRIORITY|DELAYED|QUICK|IGNORE)\s+)*"
+# table lists of FROM and UPDATE, e.g. "FROM a, b AS x WHERE ..."
+_LIST_RE = re.compile(
+    r"\b(?:FROM|UPDATE)\s+%s(.*?)(?=\b(?:WHERE|SET|JOIN|STRAIGHT_JOIN|"
+    r"NATURAL|LEFT|RIGHT|INNER|CROSS|OUTER|ON|USING|GROUP|ORDER|LIMIT|HAVING|"
+    r"UNION|FOR|LOCK|WINDOW|PARTITION|VALUES|SELECT)\b|[();]|$)" % _MODIFIERS,
+    re.I | re.S)
+_TARGET_RE = re.compile(r"\b(?:JOIN|INTO|TABLE(?:\s+IF\s+(?:NOT\s+)?EXISTS)?|"
+                        r"STRAIGHT_JOIN)\s+(%s)" % _NAME, re.I)
+# INTO is optional for INSERT and REPLACE, TABLE for TRUNCATE
+_HEAD_RE = re.compile(r"^\s*(?:/\*.*?\*/\s*)*(?:(?:INSERT|REPLACE)\s+%s"
+                      r"(?:INTO\s+)?|TRUNCATE\s+(?:TABLE\s+)?)(%s)"
+                      % (_MODIFIERS, _NAME), re.I | re.S)
+_FIRST_NAME_RE = re.compile(r"\s*(%s)" % _NAME)
+_WRITE_RE = re.compile(r"^\s*(?:/\*.*?\*/\s*)*(?:INSERT|UPDATE|DELETE|REPLACE|"
+                       r"TRUNCATE|ALTER|DROP|RENAME|LOAD)\b", re.I | re.S)
+_STRING_RE = re.compile(r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.|\"\")*\"")
+_DUPLICATE_RE = re.compile(r"\bON\s+DUPLICATE\s+KEY\s+UPDATE\b.*", re.I | re.S)
+_VALUES_RE = re.compile(r"\bVALUES?\s*\(", re.I)
+
+_tables = {}
+_LONG_QUERY = 4096
+_unknown_writes = set()
+
+
+def tables(query, database=None):
+    """Returns the sorted names of the tables a statement refers to.
+
+    Unqualified names are qualified with database.
+    """
+    key = (query, database)
+    names = _tables.get(key)
+    if names is not None:
+        return names
+
+    long_query = len(query) > _LONG_QUERY
+    if long_query and _HEAD_RE.match(query):
+        # Most likely a multi-row insert, its table is named before the
+        # values
+        match = _VALUES_RE.search(query, 0, _LONG_QUERY)
+        if match:
+            query = query[:match.start()]
+
+    stripped = _DUPLICATE_RE.sub("", _STRING_RE.sub("?", query))
+    found = set(_TARGET_RE.findall(stripped))
+    match = _HEAD_RE.match(stripped)
+    if match:
+        found.add(match.group(1))
+    for table_list in _LIST_RE.findall(stripped):
+        for item in table_list.split(","):
+            match = _FIRST_NAME_RE.match(item)
+            if match:
+                found.add(match.group(1))
+
+    names = []
+    for name in found:
+        parts = [p.strip().strip("`").lower() for p in name.split(".")]
+        if len(parts) == 1 and database:
+            parts.insert(0, database.lower())
+        names.append(".".join(parts))
+    names = tuple(sorted(set(names)))
+
+    if not long_query:
+        if len(_tables) > 10000:
+            _tables.clear()
+        _tables[key] = names
+    return names
+
+
+def is_write(query):
+    return _WRITE_RE.match(query) is not None
+
+
+def _manager():
+    from . import cache
+    return cache.manager
+
+
+_versions = None
+
+
+def _table_versions():
+    # versions of "<database>.<table>" names, read from memcache on every
+    # query so a write is seen right away by all processes
+    global _versions
+    if _versions is None:
+        from . import cache
+        _versions = cache.Versions("qc:t")
+    return _versions
+
+
+def invalidate(names):
+    """Bumps the version of the given tables."""
+    if _manager() is not None:
+        _table_versions().invalidate(*names)
+
+
+def invalidate_statement(database, query):
+    """Invalidates the tables written by a statement, if it is a write.
+
+    Writes whose tables cannot be found are logged once per fingerprint,
+    results cached from those tables may be stale until they expire.
+    """
+    if not is_write(query):
+        return
+
+    names = tables(query, database)
+    if names:
+        invalidate(names)
+        return
+
+    fp = fingerprint(query)
+    if fp not in _unknown_writes:
+        if len(_unknown_writes) > 1000:
+            _unknown_writes.clear()
+        _unknown_writes.add(fp)
+        logger.warning("Query cache cannot find the tables written by: %s",
+                       fp)
+
+
+class QueryCache(object):
+
+    """Read-through cache in front of the query/get of a connection
+
+    Statements whose tables cannot be found are not cached.
+    """
+
+    def __init__(self, connection, database, timeout=300):
+        self.connection = connection
+        self.database = database
+        self.timeout = timeout
+
+    def query(self, query, *parameters, **kwparameters):
+        manager = _manager() if options.db_query_cache else None
+        names = tables(query, self.database) if manager else None
+        if not names:
+            return self.connection.query(query, *parameters, **kwparameters)
+
+        table_versions = _table_versions().versions(names)
+        code = hashlib.md5(utf8("%s|%s|%r|%r|%r" % (
+            self.database, query, parameters, sorted(kwparameters.items()),
+            table_versions)))
+        key = "qc:r:%s" % code.hexdigest()
+        if options.cache_key_prefix:
+            key = "%s:%s" % (options.cache_key_prefix, key)
+
+        rows = manager.get(key)
+        if rows is None:
+            rows = self.connection.query(query, *parameters, **kwparameters)
+            manager.set(key, rows, self.timeout)
+        return rows
+
+    def get(self, query, *parameters, **kwparameters):
+        rows = self.query(query, *parameters, **kwparameters)
+        if not rows:
+            return None
+        elif len(rows) > 1:
+            raise Exception("Multiple rows returned for Database.get() query")
+        else:
+            return rows[0]
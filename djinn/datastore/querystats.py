@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright(c) 2014 palmhold.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Query statistics and slow query log
+
+Statements are normalized to a fingerprint (literals and placeholders
+replaced by ``?``) and every fingerprint gets a latency histogram and a row
+count. Statements slower than ``db_slow_query_time`` are logged to the
+``djinn.datastore.slowquery`` logger, sampled by
+``db_slow_query_sample_rate``.
+"""
+
+import bisect
+import random
+import re
+import threading
+import logging
+
+from six import iteritems
+from tornado.options import options, define
+
+define("db_query_stats", True, bool,
+       "whether collect per statement latency statistics")
+define("db_slow_query_time", 1.0, float,
+       "seconds after which a statement goes to the slow query log, "
+       "0 to disable")
+define("db_slow_query_sample_rate", 1.0, float,
+       "fraction of the slow statements actually logged")
+
+slow_logger = logging.getLogger("djinn.datastore.slowquery")
+
+# histogram bucket upper bounds in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+           2.5, 5.0, 10.0, float("inf"))
+
+_STRING_RE = re.compile(r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.|\"\")*\"")
+_COMMENT_RE = re.compile(r"/\*.*?\*/|(?:--|#)[^\n]*", re.S)
+_PLACEHOLDER_RE = re.compile(r"%(?:\([^)]*\))?s")
+_NUMBER_RE = re.compile(r"\b-?\d+(?:\.\d+)?(?:e[+-]?\d+)?\b", re.I)
+_LIST_RE = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+_LISTS_RE = re.compile(r"\(\?\+\)(?:\s*,\s*\(\?\+\))+")
+_SPACE_RE = re.compile(r"\s+")
+_VALUES_RE = re.compile(r"\bvalues\b", re.I)
+
+_fingerprints = {}
+_LONG_QUERY = 4096
+
+
+def fingerprint(query):
+    """Returns the normalized form of a statement.
+
+    ``SELECT * FROM t WHERE id IN (1, 2, 3) AND name = 'x'`` and
+    ``select * from t where id in (%s, %s) and name = %s`` both become
+    ``select * from t where id in (?+) and name = ?``.
+    """
+    fp = _fingerprints.get(query)
+    if fp is not None:
+        return fp
+
+    if len(query) > _LONG_QUERY:
+        # Most likely a multi-row insert, do not scan megabytes of values
+        match = _VALUES_RE.search(query, 0, _LONG_QUERY)
+        if match:
+            return _normalize(query[:match.end()]) + " (?+)"
+        return _normalize(query[:_LONG_QUERY]) + " ..."
+
+    fp = _normalize(query)
+    if len(_fingerprints) > 10000:
+        _fingerprints.clear()
+    _fingerprints[query] = fp
+    return fp
+
+
+def _normalize(query):
+    query = _STRING_RE.sub("?", query)
+    query = _COMMENT_RE.sub(" ", query)
+    query = _PLACEHOLDER_RE.sub("?", query)
+    query = _NUMBER_RE.sub("?", query)
+    query = _LIST_RE.sub("(?+)", query)
+    query = _LISTS_RE.sub("(?+)", query)
+    return _SPACE_RE.sub(" ", query).strip().lower()
+
+
+class Statement(object):
+
+    """A statement with its parameters, only formatted when printed."""
+
+    __slots__ = ("query", "parameters")
+
+    def __init__(self, query, parameters):
+        self.query = query
+        self.parameters = parameters
+
+    def __str__(self):
+        try:
+            sql = self.query % self.parameters
+        except Exception:
+            sql = "%s %r" % (self.query, self.parameters)
+        if len(sql) > _LONG_QUERY:
+            sql = "%s... (%d bytes)" % (sql[:_LONG_QUERY], len(sql))
+        return sql
+
+
+class Histogram(object):
+
+    """Latency histogram with fixed buckets"""
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.rows = 0
+
+    def add(self, elapsed, rows):
+        self.counts[bisect.bisect_left(BUCKETS, elapsed)] += 1
+        self.count += 1
+        self.total += elapsed
+        self.rows += rows
+        if elapsed > self.max:
+            self.max = elapsed
+
+    def percentile(self, p):
+        """Returns the upper bound of the bucket holding the p percentile."""
+        rank = self.count * p / 100.0
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def as_dict(self):
+        return {"count": self.count,
+                "total": self.total,
+                "avg": self.total / self.count if self.count else 0.0,
+                "max": self.max,
+                "p50": self.percentile(50),
+                "p95": self.percentile(95),
+                "p99": self.percentile(99),
+                "rows": self.rows,
+                "buckets": dict((str(b), c) for b, c
+                                in zip(BUCKETS, self.counts) if c)}
+
+
+class QueryStats(object):
+
+    """Per fingerprint statement statistics
+
+    At most max_fingerprints fingerprints are tracked, later ones are
+    accounted under ``<other>``.
+    """
+
+    def __init__(self, max_fingerprints=1000):
+        self.max_fingerprints = max_fingerprints
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def add(self, query, elapsed, rows=0):
+        fp = fingerprint(query)
+        with self._lock:
+            histogram = self._histograms.get(fp)
+            if histogram is None:
+                if len(self._histograms) >= self.max_fingerprints:
+                    fp = "<other>"
+                    histogram = self._histograms.get(fp)
+                if histogram is None:
+                    histogram = self._histograms[fp] = Histogram()
+            histogram.add(elapsed, rows)
+
+    def snapshot(self):
+        """Returns the statistics of every fingerprint, most time
+        consuming first."""
+        with self._lock:
+            stats = [dict(h.as_dict(), fingerprint=fp)
+                     for fp, h in iteritems(self._histograms)]
+        stats.sort(key=lambda s: s["total"], reverse=True)
+        return stats
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+
+
+query_stats = QueryStats()
+
+
+def record(host, query, parameters, elapsed, rowcount):
+    """Accounts an executed statement and logs it when it is slow."""
+    # unbuffered cursors report -1 (or its unsigned value)
+    rows = rowcount if 0 <= rowcount < 2 ** 63 else 0
+    if options.db_query_stats:
+        query_stats.add(query, elapsed, rows)
+
+    threshold = options.db_slow_query_time
+    if threshold and elapsed >= threshold and \
+            random.random() < options.db_slow_query_sample_rate:
+        slow_logger.warning("%.3f seconds on %s, %s rows: %s", elapsed, host,
+                            rows, Statement(query, parameters))
+
+
+def snapshot():
+    return query_stats.snapshot()
+
+
+def reset():
+    query_stats.reset()
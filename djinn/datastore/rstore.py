@@ -14,16 +14,45 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import logging
+import threading
+import weakref
+
+from concurrent.futures import Future, ThreadPoolExecutor
+
 import redis
 
-from six import iteritems
+from six import binary_type, iteritems, text_type
 
 from ..errors import DatastoreError
+from .hashring import HashRing
 
 manager = None
 
+logger = logging.getLogger(__name__)
+
 
 def setup(redis_pool, decode_responses=False):
+    """Sets up the global RstoreManager.
+
+    redis_pool maps instance names to the redis.Redis arguments of each
+    instance, plus the options of its BlockingConnectionPool:
+
+    * max_connections: most sockets opened to the instance (50)
+    * pool_timeout: seconds to wait for a free connection before raising
+      redis.ConnectionError (5)
+    * health_check_interval: seconds a connection can stay idle before it
+      is checked with a PING when taken (30)
+
+    An instance made of several servers is configured with "shards", see
+    ShardedRedis, or with "cluster" for a Redis Cluster::
+
+        {
+            "sessions": {"host": "10.0.0.1", "max_connections": 100},
+            "feeds": {"shards": [{"host": "10.0.0.2"}, {"host": "10.0.0.3"}]},
+            "counters": {"cluster": True, "host": "10.0.0.4", "port": 7000},
+        }
+    """
     global manager
 
     if manager is None:
@@ -31,21 +60,530 @@ def setup(redis_pool, decode_responses=False):
     return manager
 
 
+class BlockingConnectionPool(redis.BlockingConnectionPool):
+    """Blocking pool counting the checkouts that waited or timed out."""
+
+    def __init__(self, *args, **kwargs):
+        super(BlockingConnectionPool, self).__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.waits = 0
+        self.timeouts = 0
+        self._stats_lock = threading.Lock()
+
+    def get_connection(self, *args, **kwargs):
+        with self._stats_lock:
+            self.checkouts += 1
+            if self.pool.empty():
+                self.waits += 1
+        try:
+            return super(BlockingConnectionPool, self).get_connection(
+                *args, **kwargs)
+        except redis.ConnectionError as e:
+            if "No connection available" in str(e):
+                with self._stats_lock:
+                    self.timeouts += 1
+                logger.warning("Redis pool of %s exhausted, %d connections "
+                               "in use", self.connection_kwargs.get(
+                                   "host", "localhost"), self.max_connections)
+            raise
+
+    def stats(self):
+        idle = sum(1 for c in list(self.pool.queue) if c is not None)
+        opened = len(self._connections)
+        return {
+            "max_connections": self.max_connections,
+            "connections": opened,
+            "in_use": opened - idle,
+            "idle": idle,
+            "checkouts": self.checkouts,
+            "waits": self.waits,
+            "timeouts": self.timeouts,
+        }
+
+
+def connection_pool(options, decode_responses=False, module=None):
+    """Builds the BlockingConnectionPool of an instance from its options.
+
+    With module redis.asyncio, builds the pool of an asyncio client.
+    """
+    options = dict(options)
+    options.setdefault("decode_responses", decode_responses)
+    options.setdefault("health_check_interval", 30)
+    max_connections = options.pop("max_connections", 50)
+    timeout = options.pop("pool_timeout", 5)
+
+    pool_class = BlockingConnectionPool
+    if module is not None:
+        pool_class = module.BlockingConnectionPool
+    else:
+        module = redis
+
+    if "unix_socket_path" in options:
+        options["path"] = options.pop("unix_socket_path")
+        options["connection_class"] = module.UnixDomainSocketConnection
+    elif options.pop("ssl", False):
+        options["connection_class"] = module.SSLConnection
+    return pool_class(max_connections=max_connections, timeout=timeout,
+                      **options)
+
+
 class RstoreManager(object):
     _datastore_pool = {}
 
     def __init__(self, datastore_pool, decode_responses=False):
+        self.aio = AsyncRstore(datastore_pool, decode_responses)
         for k, v in iteritems(datastore_pool):
-            RstoreManager._datastore_pool[k] = redis.Redis(decode_responses=decode_responses, **v)
+            if "shards" in v:
+                conn = ShardedRedis(v, decode_responses)
+            elif v.get("cluster"):
+                conn = cluster(v, decode_responses)
+            else:
+                conn = redis.Redis(
+                    connection_pool=connection_pool(v, decode_responses))
+            RstoreManager._datastore_pool[k] = conn
 
     def __getattr__(self, instance):
         conn = self._datastore_pool.get(instance, None)
-        if not conn:
+        if conn is None:
             raise DatastoreError("Redis %s instance does not exist"
                                  % instance)
 
         return conn
 
+    def pool_stats(self):
+        """Connection pool usage of every instance, by node when sharded."""
+        stats = {}
+        for k, v in iteritems(self._datastore_pool):
+            if isinstance(v, ShardedRedis):
+                stats[k] = v.pool_stats()
+            elif isinstance(v, redis.Redis):
+                stats[k] = v.connection_pool.stats()
+        return stats
+
+
+class AsyncRstore(object):
+    """redis.asyncio clients of the instances of a RstoreManager.
+
+    Clients are built from the same options on first use, one per instance
+    and event loop, since asyncio connections cannot be shared between
+    loops::
+
+        value = await rstore.manager.aio.default.get("key")
+
+    Needs Python 3 and redis-py 4.2 or later. Sharded instances have no
+    asyncio client.
+    """
+
+    def __init__(self, datastore_pool, decode_responses=False):
+        self._datastore_pool = datastore_pool
+        self._decode_responses = decode_responses
+        self._clients = weakref.WeakKeyDictionary()
+
+    def __getattr__(self, instance):
+        import asyncio
+        options = self._datastore_pool.get(instance)
+        if options is None:
+            raise DatastoreError("Redis %s instance does not exist"
+                                 % instance)
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = asyncio.get_event_loop()
+        clients = self._clients.get(loop)
+        if clients is None:
+            clients = self._clients[loop] = {}
+
+        client = clients.get(instance)
+        if client is None:
+            client = clients[instance] = self._client(options)
+        return client
+
+    def _client(self, options):
+        try:
+            import redis.asyncio
+        except ImportError:
+            raise DatastoreError("Asyncio redis needs redis-py 4.2 or later")
+
+        if "shards" in options:
+            raise DatastoreError("Sharded redis instances have no asyncio "
+                                 "client")
+        if options.get("cluster"):
+            return cluster(options, self._decode_responses, asyncio=True)
+        return redis.asyncio.Redis(connection_pool=connection_pool(
+            options, self._decode_responses, redis.asyncio))
+
+
+def cluster(options, decode_responses=False, asyncio=False):
+    """Builds the redis.cluster.RedisCluster of a cluster instance.
+
+    Needs redis-py 4.1 or later, 4.3 for asyncio. Commands are routed by
+    hash slot and multi-key commands like mget_nonatomic and pipelines are
+    split per node by redis-py itself.
+    """
+    try:
+        if asyncio:
+            from redis.asyncio.cluster import ClusterNode, RedisCluster
+        else:
+            from redis.cluster import ClusterNode, RedisCluster
+    except ImportError:
+        raise DatastoreError("Redis Cluster needs redis-py 4.1 or later")
+
+    options = dict(options)
+    options.pop("cluster")
+    options.setdefault("decode_responses", decode_responses)
+    options.setdefault("health_check_interval", 30)
+    nodes = options.pop("startup_nodes", None)
+    if nodes:
+        options["startup_nodes"] = [
+            ClusterNode(n["host"], n.get("port", 6379)) for n in nodes]
+    return RedisCluster(**options)
+
+
+def _hash_part(key):
+    """The part of key that is hashed, the content of the first {...} if
+    any like in Redis Cluster, so related keys can be kept together."""
+    if not isinstance(key, (binary_type, text_type)):
+        key = str(key)
+    if isinstance(key, binary_type):
+        start, end = key.find(b"{"), -1
+        if start >= 0:
+            end = key.find(b"}", start + 1)
+    else:
+        start, end = key.find("{"), -1
+        if start >= 0:
+            end = key.find("}", start + 1)
+    if end > start + 1:
+        return key[start + 1:end]
+    return key
+
+
+class ShardedRedis(object):
+
+    """Redis instance made of several servers
+
+    ``shards`` lists the options of every server, like unsharded
+    instances, plus an optional "weight" and "name". Keys are placed on a
+    hashring.HashRing of the names ("host:port/db" by default), so adding
+    or removing a server only moves its share of keys. Like in Redis
+    Cluster, only the content of the first {...} of a key is hashed when
+    it has one.
+
+    Commands are sent to the server of their first argument. Commands
+    reading or writing several keys other than mget, mset, delete, exists,
+    unlink and touch need those keys on one server, i.e. a common
+    {hashtag}. mget and friends and pipelines are split per server, sent
+    in parallel and their replies put back in order::
+
+        r = manager.feeds
+        r.lpush("feed:{42}", item_id)
+        r.mget(["user:1", "user:2", "user:3"])
+        pipe = r.pipeline()
+        pipe.incr("views:1").incr("views:2")
+        pipe.execute()
+    """
+
+    def __init__(self, config, decode_responses=False):
+        self.nodes = []
+        nodes = []
+        for options in config["shards"]:
+            options = dict(options)
+            weight = options.pop("weight", 1)
+            name = options.pop("name", None) or "%s:%s/%s" % (
+                options.get("host", "localhost"), options.get("port", 6379),
+                options.get("db", 0))
+            node = redis.Redis(
+                connection_pool=connection_pool(options, decode_responses))
+            node.name = name
+            self.nodes.append(node)
+            nodes.append((name, len(nodes), weight))
+        if not self.nodes:
+            raise DatastoreError("Sharded redis instance without shards")
+
+        self.ring = HashRing(nodes, config.get("vnodes", 160))
+        self._executor = ThreadPoolExecutor(len(self.nodes))
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        def command(*args, **kwargs):
+            return self._execute(*self._split(name, args, kwargs))
+
+        return command
+
+    def index(self, key):
+        return self.ring.get_node(_hash_part(key))
+
+    def node(self, key):
+        """Returns the redis.Redis holding key."""
+        return self.nodes[self.index(key)]
+
+    def _group(self, keys):
+        groups = {}
+        for position, key in enumerate(keys):
+            groups.setdefault(self.index(key), []).append(position)
+        return sorted(iteritems(groups))
+
+    def _split(self, name, args, kwargs):
+        """Returns the [(node index, name, args, kwargs)] parts of a command
+        and the function merging their replies."""
+        if name == "mget":
+            keys = list(args[0]) if len(args) == 1 and \
+                isinstance(args[0], (list, tuple)) else list(args)
+            groups = self._group(keys)
+
+            def merge(replies):
+                values = [None] * len(keys)
+                for (_, positions), reply in zip(groups, replies):
+                    for position, value in zip(positions, reply):
+                        values[position] = value
+                return values
+
+            return [(i, name, ([keys[p] for p in positions],), {})
+                    for i, positions in groups], merge
+
+        if name in ("delete", "exists", "unlink", "touch"):
+            groups = self._group(args)
+            return [(i, name, tuple(args[p] for p in positions), {})
+                    for i, positions in groups], sum
+
+        if name == "mset":
+            mapping = args[0]
+            keys = list(mapping)
+            return [(i, name, (dict((keys[p], mapping[keys[p]])
+                                    for p in positions),), {})
+                    for i, positions in self._group(keys)], all
+
+        if not args:
+            raise DatastoreError("Sharded redis cannot route %s without a key,"
+                                 " use scatter" % name)
+        return [(self.index(args[0]), name, args, kwargs)], \
+            lambda replies: replies[0]
+
+    def _execute(self, parts, merge):
+        if len(parts) == 1:
+            i, name, args, kwargs = parts[0]
+            return merge([getattr(self.nodes[i], name)(*args, **kwargs)])
+
+        futures = [self._executor.submit(getattr(self.nodes[i], name),
+                                         *args, **kwargs)
+                   for i, name, args, kwargs in parts]
+        return merge([f.result() for f in futures])
+
+    def scatter(self, func):
+        """Calls func(node) on every node in parallel, returns the results
+        in node order."""
+        futures = [self._executor.submit(func, node) for node in self.nodes]
+        return [f.result() for f in futures]
+
+    def ping(self):
+        return all(self.scatter(lambda node: node.ping()))
+
+    def flushdb(self):
+        return all(self.scatter(lambda node: node.flushdb()))
+
+    def dbsize(self):
+        return sum(self.scatter(lambda node: node.dbsize()))
+
+    def keys(self, pattern="*"):
+        keys = []
+        for result in self.scatter(lambda node: node.keys(pattern)):
+            keys.extend(result)
+        return keys
+
+    def pipeline(self, transaction=False):
+        """Returns a ShardedPipeline, transactions are not supported."""
+        if transaction:
+            raise DatastoreError("Sharded redis pipelines cannot be "
+                                 "transactions")
+        return ShardedPipeline(self)
+
+    def pool_stats(self):
+        return dict((node.name, node.connection_pool.stats())
+                    for node in self.nodes)
+
+
+class ShardedPipeline(object):
+    """Pipeline of a ShardedRedis, sending one pipeline per server."""
+
+    def __init__(self, sharded):
+        self.sharded = sharded
+        self.command_stack = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.reset()
+
+    def __len__(self):
+        return len(self.command_stack)
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        def command(*args, **kwargs):
+            self.command_stack.append(
+                self.sharded._split(name, args, kwargs))
+            return self
+
+        return command
+
+    def reset(self):
+        self.command_stack = []
+
+    def execute(self, raise_on_error=True):
+        stack, self.command_stack = self.command_stack, []
+        by_node = {}
+        for c, (parts, _) in enumerate(stack):
+            for p, (i, name, args, kwargs) in enumerate(parts):
+                by_node.setdefault(i, []).append((c, p, name, args, kwargs))
+
+        def send(i):
+            pipe = self.sharded.nodes[i].pipeline(transaction=False)
+            for _, _, name, args, kwargs in by_node[i]:
+                getattr(pipe, name)(*args, **kwargs)
+            try:
+                return pipe.execute(raise_on_error=False)
+            except Exception as e:
+                return [e] * len(by_node[i])
+
+        replies = [[None] * len(parts) for parts, _ in stack]
+        nodes = sorted(by_node)
+        futures = [self.sharded._executor.submit(send, i) for i in nodes]
+        for i, future in zip(nodes, futures):
+            for (c, p, _, _, _), reply in zip(by_node[i], future.result()):
+                replies[c][p] = reply
+
+        results = []
+        for (_, merge), command_replies in zip(stack, replies):
+            errors = [r for r in command_replies if isinstance(r, Exception)]
+            results.append(errors[0] if errors else merge(command_replies))
+        if raise_on_error:
+            for result in results:
+                if isinstance(result, Exception):
+                    raise result
+        return results
+
+
+class PipelineResult(Future):
+    """Future result of a command buffered by an AutoPipeline.
+
+    Calling result() sends the buffered commands if it is not known yet,
+    so call it rather than yielding the result from a coroutine.
+    """
+
+    def __init__(self, pipeline, command):
+        super(PipelineResult, self).__init__()
+        self._pipeline = pipeline
+        self.command = command
+        self.retrieved = False
+
+    def result(self, timeout=None):
+        if not self.done():
+            self._pipeline.flush()
+        self.retrieved = True
+        return super(PipelineResult, self).result(timeout)
+
+    def exception(self, timeout=None):
+        if not self.done():
+            self._pipeline.flush()
+        self.retrieved = True
+        return super(PipelineResult, self).exception(timeout)
+
+
+class AutoPipeline(object):
+    """Buffers the commands sent to a redis client into a pipeline.
+
+    Commands return PipelineResults and are sent together, in order, when
+    one of their results is needed, when max_commands are buffered or when
+    the with block ends::
+
+        with AutoPipeline(manager.default) as r:
+            views = r.incr("views:%s" % post_id)
+            r.expire("views:%s" % post_id, 86400)
+            likes = r.scard("likes:%s" % post_id)
+        print(views.result(), likes.result())
+
+    Methods that cannot be pipelined are called on the client directly
+    once the buffered commands are sent.
+
+    Commands nobody reads the result of, typically writes, fail silently
+    until close(), which the with block calls, logs their errors.
+    """
+
+    _direct = frozenset(["pipeline", "pubsub", "lock", "transaction",
+                         "register_script", "scan_iter", "hscan_iter",
+                         "sscan_iter", "zscan_iter", "monitor"])
+
+    def __init__(self, client, max_commands=100):
+        self.client = client
+        self.max_commands = max_commands
+        self._pipeline = client.pipeline(transaction=False)
+        self._results = []
+        self._failed = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return len(self._results)
+
+    def __getattr__(self, name):
+        if name in self._direct:
+            self.flush()
+            return getattr(self.client, name)
+
+        method = getattr(self._pipeline, name)
+
+        def command(*args, **kwargs):
+            method(*args, **kwargs)
+            result = PipelineResult(self, name)
+            self._results.append(result)
+            if len(self._results) >= self.max_commands:
+                self.flush()
+            return result
+
+        return command
+
+    def flush(self):
+        """Sends the buffered commands and resolves their results."""
+        if not self._results:
+            return
+        results, self._results = self._results, []
+        try:
+            replies = self._pipeline.execute(raise_on_error=False)
+        except Exception as e:
+            self._pipeline.reset()
+            for result in results:
+                result.set_exception(e)
+            self._failed.extend(results)
+            raise
+
+        for result, reply in zip(results, replies):
+            if isinstance(reply, Exception):
+                result.set_exception(reply)
+                self._failed.append(result)
+            else:
+                result.set_result(reply)
+
+    def close(self):
+        """Sends the buffered commands and logs the errors nobody read."""
+        try:
+            self.flush()
+        finally:
+            failed, self._failed = self._failed, []
+            for result in failed:
+                if not result.retrieved:
+                    logger.error("Redis %s failed in pipeline: %s",
+                                 result.command,
+                                 Future.exception(result))
+
 
 class RedistoreException(Exception):
     pass
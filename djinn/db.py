@@ -18,10 +18,15 @@ from __future__ import absolute_import, division, with_statement
 
 import copy
 import logging
+import operator
 import os
 import time
 
+from concurrent.futures import ThreadPoolExecutor
+
 import pymysql
+from six import integer_types, string_types, text_type
+from tornado.concurrent import run_on_executor
 
 logger = logging.getLogger(__name__)
 
@@ -42,14 +47,24 @@ class Connection(object):
     any other mode including blank (None) thereby explicitly clearing the SQL mode.
 
     Arguments read_timeout and write_timeout can be passed using kwargs, if MySQL version > 5.1.12.
+
+    Rows are built by row_factory, Row by default. CompactRow saves memory
+    and CPU on large result sets. The factory can also be chosen per query
+    with the reserved row_factory keyword::
+
+        db.query("SELECT * FROM log", row_factory=CompactRow)
     """
     def __init__(self, host, database, user=None, password=None,
                  max_idle_time=7 * 3600, connect_timeout=10,
                  time_zone="+0:00", charset = "utf8", sql_mode="TRADITIONAL",
-                 **kwargs):
+                 row_factory=None, **kwargs):
         self.host = host
         self.database = database
         self.max_idle_time = float(max_idle_time)
+        self.row_factory = row_factory or Row
+        # net_write_timeout of the connections opened by iter_batches, how
+        # long the server waits for a slow consumer before giving up
+        self.stream_timeout = 3600
 
         args = dict(conv=CONVERSIONS, use_unicode=True, charset=charset,
                     db=database, init_command=('SET time_zone = "%s"' % time_zone),
@@ -75,6 +90,7 @@ class Connection(object):
         self._db = None
         self._db_args = args
         self._last_use_time = time.time()
+        self._aio = None
         try:
             self.reconnect()
         except Exception:
@@ -96,25 +112,91 @@ class Connection(object):
         self._db = pymysql.connect(**self._db_args)
         self._db.autocommit(True)
 
+    @property
+    def aio(self):
+        """An AsyncConnection running the queries of this connection.
+
+        A single connection can only run one statement at a time, so the
+        queries are serialized on one worker thread.
+        """
+        if self._aio is None:
+            self._aio = AsyncConnection(self)
+        return self._aio
+
     def iter(self, query, *parameters, **kwparameters):
         """Returns an iterator for the given query and parameters."""
+        row_factory = kwparameters.pop("row_factory", None) or self.row_factory
         self._ensure_connected()
         cursor = pymysql.cursors.SSCursor(self._db)
         try:
             self._execute(cursor, query, parameters, kwparameters)
-            column_names = [d[0] for d in cursor.description]
+            make_row = row_factory.factory([d[0] for d in cursor.description])
             for row in cursor:
-                yield Row(zip(column_names, row))
+                yield make_row(row)
         finally:
             cursor.close()
 
+    def iter_batches(self, query, *parameters, **kwparameters):
+        """Returns an iterator of row lists for the given query and parameters.
+
+        Rows are streamed by an unbuffered cursor over a dedicated connection
+        and fetched batch_size (a reserved keyword, 1000 by default) at a
+        time, so memory stays bounded whatever the size of the result and
+        this connection remains available to other queries. The server only
+        sends rows as fast as they are consumed.
+
+        Closing an unfinished iterator, or dropping it, closes the dedicated
+        connection without reading the rest of the result.
+        """
+        return self._stream(self._dedicated, query, parameters, kwparameters)
+
+    @staticmethod
+    def _stream(connect, query, parameters, kwparameters):
+        # connect returns the dedicated connection, only called once the
+        # iteration starts
+        conn = connect()
+        if conn._db is None:
+            conn.reconnect()
+        batch_size = int(kwparameters.pop("batch_size", 1000))
+        row_factory = kwparameters.pop("row_factory", None) or conn.row_factory
+        finished = False
+        try:
+            cursor = conn._db.cursor()
+            try:
+                cursor.execute("SET SESSION net_write_timeout = %s",
+                               (int(conn.stream_timeout),))
+            finally:
+                cursor.close()
+
+            cursor = pymysql.cursors.SSCursor(conn._db)
+            conn._execute(cursor, query, parameters, kwparameters)
+            make_row = row_factory.factory([d[0] for d in cursor.description])
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield [make_row(row) for row in rows]
+            cursor.close()
+            finished = True
+        finally:
+            if not finished:
+                # Closing the cursor would read the rest of the result
+                # first, drop the connection instead.
+                logger.debug("Closing unfinished streaming query on %s",
+                             conn.host)
+            try:
+                conn.close()
+            except Exception:
+                conn._db = None
+
     def query(self, query, *parameters, **kwparameters):
         """Returns a row list for the given query and parameters."""
+        row_factory = kwparameters.pop("row_factory", None) or self.row_factory
         cursor = self._cursor()
         try:
             self._execute(cursor, query, parameters, kwparameters)
-            column_names = [d[0] for d in cursor.description]
-            return [Row(zip(column_names, row)) for row in cursor]
+            make_row = row_factory.factory([d[0] for d in cursor.description])
+            return [make_row(row) for row in cursor]
         finally:
             cursor.close()
 
@@ -170,8 +252,8 @@ class Connection(object):
         """
         cursor = self._cursor()
         try:
-            cursor.executemany(query, parameters)
-            # return cursor.lastrowid
+            self._executemany(cursor, query, parameters)
+            return cursor.lastrowid
         finally:
             cursor.close()
 
@@ -182,11 +264,88 @@ class Connection(object):
         """
         cursor = self._cursor()
         try:
-            cursor.executemany(query, parameters)
+            self._executemany(cursor, query, parameters)
             return cursor.rowcount
         finally:
             cursor.close()
 
+    def bulk_insert(self, table, columns, rows, update=None, max_packet=None,
+                    max_rows=None):
+        """Inserts rows with as few multi-row INSERT statements as possible.
+
+        ``rows`` is any iterable of value sequences ordered like ``columns``.
+        It is consumed lazily and statements are flushed as soon as they
+        would exceed ``max_packet`` bytes (the server's max_allowed_packet
+        by default) or ``max_rows`` rows, so an iterator of millions of rows
+        is streamed with a bounded buffer.
+
+        ``update`` turns the statements into INSERT ... ON DUPLICATE KEY
+        UPDATE, either with a list of columns to overwrite with the
+        inserted values or with a raw assignment clause.
+
+        Returns a Row with the total ``rowcount`` (for upserts mysql counts
+        1 per inserted and 2 per updated row), the number of ``statements``
+        and, for plain inserts into a table with an auto increment column,
+        the ``ids`` as a list of (first, last) ranges, one per statement.
+        Ranges rely on the ids of a multi-row insert being consecutive,
+        which innodb guarantees for such simple inserts.
+        """
+        self._ensure_connected()
+        if max_packet is None:
+            max_packet = self._max_allowed_packet() - 1024
+
+        head = "INSERT INTO %s (%s) VALUES " % (
+            _quote_name(table), ", ".join(_quote_name(c) for c in columns))
+        if not update:
+            tail = ""
+        elif isinstance(update, string_types):
+            tail = " ON DUPLICATE KEY UPDATE " + update
+        else:
+            tail = " ON DUPLICATE KEY UPDATE " + ", ".join(
+                "%s=VALUES(%s)" % (c, c) for c in map(_quote_name, update))
+
+        result = Row(rowcount=0, statements=0, ids=[])
+        base_size = _byte_size(head) + _byte_size(tail)
+        values, size = [], base_size
+        for row in rows:
+            value = "(%s)" % ",".join(self._db.literal(v) for v in row)
+            value_size = _byte_size(value) + 1
+            if values and (size + value_size > max_packet or
+                           max_rows and len(values) >= max_rows):
+                self._bulk_execute(head, values, tail, result)
+                values, size = [], base_size
+            values.append(value)
+            size += value_size
+
+        if values:
+            self._bulk_execute(head, values, tail, result)
+        return result
+
+    def _bulk_execute(self, head, values, tail, result):
+        # values are already escaped, protect their % from the parameter
+        # interpolation of cursor.execute
+        query = (head + ",".join(values) + tail).replace("%", "%%")
+        cursor = self._cursor()
+        try:
+            self._execute(cursor, query, (), {})
+            result["rowcount"] += cursor.rowcount
+            result["statements"] += 1
+            if not tail and cursor.lastrowid:
+                result.ids.append((cursor.lastrowid,
+                                   cursor.lastrowid + len(values) - 1))
+        finally:
+            cursor.close()
+
+    def _max_allowed_packet(self):
+        if getattr(self, "_max_packet", None) is None:
+            cursor = self._cursor()
+            try:
+                cursor.execute("SELECT @@max_allowed_packet")
+                self._max_packet = int(cursor.fetchone()[0])
+            finally:
+                cursor.close()
+        return self._max_packet
+
     update = delete = execute_rowcount
     updatemany = executemany_rowcount
 
@@ -204,6 +363,14 @@ class Connection(object):
             self.reconnect()
         self._last_use_time = time.time()
 
+    def _dedicated(self):
+        """Returns a copy of this connection on its own socket."""
+        conn = copy.copy(self)
+        conn._db = None
+        conn._aio = None
+        conn.reconnect()
+        return conn
+
     def _cursor(self):
         self._ensure_connected()
         return self._db.cursor()
@@ -216,6 +383,70 @@ class Connection(object):
             self.close()
             raise
 
+    def _executemany(self, cursor, query, parameters):
+        try:
+            return cursor.executemany(query, parameters)
+        except OperationalError:
+            logger.error("Error connecting to MySQL on %s", self.host)
+            self.close()
+            raise
+
+
+def _on_executor(name):
+    def _wrapper(self, *args, **kwargs):
+        return getattr(self.connection, name)(*args, **kwargs)
+
+    _wrapper.__name__ = name
+    return run_on_executor(_wrapper)
+
+
+class AsyncConnection(object):
+    """Awaitable counterpart of a Connection.
+
+    Every method runs the blocking method of the same name on a thread pool
+    executor and returns a Future, so the IOLoop keeps serving requests
+    while the statement is executing::
+
+        rows = await db.aio.query("SELECT * FROM users WHERE id > %s", 10)
+
+    Results and logging are the ones of the wrapped connection. To keep
+    several queries in flight, wrap something that can run them
+    concurrently (e.g. a connection pool) and size max_workers after it.
+    """
+    def __init__(self, connection, executor=None, max_workers=1):
+        self.connection = connection
+        self.executor = executor or ThreadPoolExecutor(max_workers)
+
+    def close(self):
+        """Shuts the executor down, pending queries still complete."""
+        self.executor.shutdown(wait=False)
+
+    query = _on_executor("query")
+    get = _on_executor("get")
+    execute = _on_executor("execute")
+    execute_lastrowid = _on_executor("execute_lastrowid")
+    execute_rowcount = _on_executor("execute_rowcount")
+    executemany = _on_executor("executemany")
+    executemany_lastrowid = _on_executor("executemany_lastrowid")
+    executemany_rowcount = _on_executor("executemany_rowcount")
+
+    bulk_insert = _on_executor("bulk_insert")
+
+    update = delete = execute_rowcount
+    updatemany = executemany_rowcount
+
+    insert = execute_lastrowid
+    insertmany = executemany_lastrowid
+
+
+def _quote_name(name):
+    return ".".join("`%s`" % part.replace("`", "``")
+                    for part in name.split("."))
+
+
+def _byte_size(s):
+    return len(s.encode("utf-8") if isinstance(s, text_type) else s)
+
 
 class Row(dict):
     """A dict that allows for object-like property access syntax."""
@@ -225,8 +456,123 @@ class Row(dict):
         except KeyError:
             raise AttributeError(name)
 
+    @classmethod
+    def factory(cls, column_names):
+        """Returns a callable building rows from value tuples."""
+        return lambda values: cls(zip(column_names, values))
+
+
+class CompactRow(tuple):
+    """A read-only row sharing its column index with its result set.
+
+    Each row is a plain tuple of values; the column names live once on a
+    class generated per column list, so large result sets cost a fraction
+    of the memory and time of one Row dict per row. Columns are accessible
+    like with Row: row.name, row["name"], row.get("name"), keys(), items().
+    Positional access (row[0]) and iteration yield the values.
+
+    Being a tuple, a CompactRow is JSON encoded as an array, use to_dict()
+    when the column names matter.
+    """
+    __slots__ = ()
+    _columns = ()
+    _index = {}
+
+    @classmethod
+    def factory(cls, column_names):
+        return _compact_row_class(tuple(column_names))
+
+    def __getitem__(self, key):
+        if isinstance(key, integer_types + (slice,)):
+            return tuple.__getitem__(self, key)
+        try:
+            return tuple.__getitem__(self, self._index[key])
+        except KeyError:
+            raise KeyError(key)
+
+    def __getattr__(self, name):
+        try:
+            return tuple.__getitem__(self, self._index[name])
+        except KeyError:
+            raise AttributeError(name)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __reduce__(self):
+        return _compact_row, (self._columns, tuple(self))
+
+    def __repr__(self):
+        return "%s(%s)" % (self.__class__.__name__, ", ".join(
+            "%s=%r" % item for item in self.items()))
+
+    def get(self, key, default=None):
+        index = self._index.get(key)
+        return default if index is None else tuple.__getitem__(self, index)
+
+    def keys(self):
+        return list(self._columns)
+
+    def values(self):
+        return list(self)
+
+    def items(self):
+        return list(zip(self._columns, self))
+
+    def to_dict(self):
+        return Row(zip(self._columns, self))
+
+
+_compact_row_classes = {}
+
+
+def _compact_row_class(columns):
+    cls = _compact_row_classes.get(columns)
+    if cls is None:
+        index = dict((name, i) for i, name in enumerate(columns))
+        attrs = {"__slots__": (), "_columns": columns, "_index": index}
+        # properties are faster than __getattr__ and take precedence over
+        # tuple methods, so a column named "count" or "index" still works
+        for name, i in index.items():
+            if name in ("count", "index") or (
+                    not name.startswith("_") and not hasattr(CompactRow, name)):
+                attrs[name] = property(operator.itemgetter(i))
+        cls = type("CompactRow", (CompactRow,), attrs)
+        if len(_compact_row_classes) > 1024:
+            _compact_row_classes.clear()
+        _compact_row_classes[columns] = cls
+    return cls
+
+
+def _compact_row(columns, values):
+    return _compact_row_class(columns)(values)
+
 CONVERSIONS = copy.copy(pymysql.converters.conversions)
 
 # Alias some common MySQL exceptions
 IntegrityError = pymysql.IntegrityError
 OperationalError = pymysql.OperationalError
+ProgrammingError = pymysql.ProgrammingError
+
+
+if __name__ == "__main__":
+    # Benchmark building and reading a 50k rows result set with Row and
+    # CompactRow.
+    import sys
+    import timeit
+
+    column_names = ["id", "name", "email", "status", "created_at"]
+    values = [(i, "user%d" % i, "user%d@example.com" % i, 1, 1400000000 + i)
+              for i in range(50000)]
+
+    for factory in (Row, CompactRow):
+        make_row = factory.factory(column_names)
+        rows = [make_row(v) for v in values]
+        build = min(timeit.repeat(lambda: [make_row(v) for v in values],
+                                  number=1, repeat=5))
+        read = min(timeit.repeat(lambda: [r.name for r in rows] and
+                                 [r["email"] for r in rows],
+                                 number=1, repeat=5))
+        size = sum(sys.getsizeof(r) for r in rows)
+        print("%-10s build %.1f ms, read %.1f ms, %.1f MB" % (
+            factory.__name__, build * 1000, read * 1000, size / 1048576.0))
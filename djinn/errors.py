@@ -26,6 +26,7 @@ ERROR_UNAUTHORIZED = 401
 ERROR_FORBIDDEN = 403
 ERROR_NOT_FOUND = 404
 ERROR_METHOD_NOT_ALLOWED = 405
+ERROR_TOO_MANY_REQUESTS = 429
 ERROR_INTERNAL_SERVER_ERROR = 500
 # Custom error code
 ERROR_WARNING = 1001
@@ -41,6 +42,7 @@ _error_types = {400: "bad_request",
                 403: "forbidden",
                 404: "not_found",
                 405: "method_not_allowed",
+                429: "too_many_requests",
                 500: "internal_server_error",
                 1001: "warning",
                 1002: "deprecated",
@@ -52,6 +54,7 @@ ERROR_MESSAGES = {400: "Bad request",
                   403: "Forbidden",
                   404: "Not found",
                   405: "Method not allowed",
+                  429: "Too many requests",
                   500: "Internal server error",
                   1001: "Warning",
                   1002: "Deprecated",
@@ -14,6 +14,7 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import math
 import re
 import traceback
 import logging
@@ -25,28 +26,126 @@ except ImportError:
 
 from six import text_type
 from tornado import escape
-from tornado.options import options
+from tornado.options import define, options
 from tornado.web import RequestHandler as BaseRequestHandler, HTTPError
 from djinn import errors
+from djinn.datastore.loader import DataLoader
 from djinn.utils import Context
 
 REMOVE_SLASH_RE = re.compile(".+/$")
 
+define("rate_limit_enabled", True, bool,
+       "whether handlers with a rate_limit are throttled")
+
 logger = logging.getLogger(__name__)
 
 
 class BaseHandler(BaseRequestHandler):
+    # name -> factory(handler) of the DataLoaders available from loader()
+    loader_factories = {}
+    # whether rstore() buffers the redis commands of a request
+    auto_pipeline = False
+    # (requests, seconds[, burst]) allowed per client, see traffic_threshold
+    rate_limit = None
+    # what clients are told apart by: "ip", "user" or "route"
+    rate_limit_by = "ip"
+    # rstore instance keeping the rate limit buckets
+    rate_limit_instance = "default"
+
     def prepare(self):
         self.remove_slash()
         self.prepare_context()
+        self.prepare_loaders()
         self.traffic_threshold()
 
     def traffic_threshold(self):
-        pass
+        """Throttles requests beyond rate_limit with a 429 HTTPAPIError.
+
+        Every handler class has its own ratelimit.RateLimiter buckets, one
+        per key returned by rate_limit_key().
+        """
+        if not self.rate_limit or not options.rate_limit_enabled:
+            return
+
+        from djinn import ratelimit
+
+        limiter = ratelimit.limiter(self.rate_limit, self.rate_limit_instance)
+        allowed, retry_after = limiter.take(
+            "%s:%s" % (type(self).__name__, self.rate_limit_key()))
+        if not allowed:
+            raise errors.HTTPAPIError(
+                errors.ERROR_TOO_MANY_REQUESTS,
+                data={"retry_after": int(math.ceil(retry_after))})
+
+    def rate_limit_key(self):
+        """The client a request is counted for, according to rate_limit_by.
+        """
+        if self.rate_limit_by == "user":
+            user = self.current_user
+            if user:
+                return "u%s" % getattr(user, "id", user)
+        elif self.rate_limit_by == "route":
+            reverse_api = getattr(self.application, "reverse_api", None)
+            name = reverse_api(self.request) if reverse_api else None
+            return name or self.request.path
+        return self.request.remote_ip
 
     def prepare_context(self):
         self._context = Context()
 
+    def prepare_loaders(self):
+        self._loaders = {}
+
+    def loader(self, name, factory=None):
+        """Returns the DataLoader registered as name for this request.
+
+        It is created on first use by factory(), or by
+        loader_factories[name](self), and lives as long as the request so
+        its memoized values are never stale for longer than that.
+        """
+        loaders = self.__dict__.setdefault("_loaders", {})
+        loader = loaders.get(name)
+        if loader is None:
+            if factory is not None:
+                loader = factory()
+            else:
+                loader = self.loader_factories[name](self)
+            assert isinstance(loader, DataLoader)
+            loaders[name] = loader
+        return loader
+
+    def rstore(self, name="default"):
+        """Returns the redis client of instance name for this request.
+
+        With auto_pipeline it is an rstore.AutoPipeline: only the commands
+        sent through it are buffered, they return PipelineResults whose
+        result() has to be called to read a reply, and are sent together
+        when a result is needed or the request finishes. Errors of
+        commands whose result was never read are logged then.
+        """
+        from djinn.datastore import rstore
+
+        client = getattr(rstore.manager, name)
+        if not self.auto_pipeline:
+            return client
+
+        pipelines = self.__dict__.setdefault("_pipelines", {})
+        pipeline = pipelines.get(name)
+        if pipeline is None:
+            pipeline = pipelines[name] = rstore.AutoPipeline(client)
+        return pipeline
+
+    def flush_pipelines(self):
+        for name, pipeline in self.__dict__.get("_pipelines", {}).items():
+            try:
+                pipeline.close()
+            except Exception:
+                logger.exception("Failed to flush redis %s pipeline", name)
+
+    def finish(self, chunk=None):
+        self.flush_pipelines()
+        return super(BaseHandler, self).finish(chunk)
+
     def remove_slash(self):
         if self.request.method == "GET":
             if REMOVE_SLASH_RE.match(self.request.path):
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright(c) 2014 palmhold.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""Redis token bucket rate limiting
+
+Each key has a bucket of burst tokens refilled at rate tokens per second,
+kept in a redis hash and updated atomically by a Lua script using the
+redis server clock. A request takes one token and is refused when the
+bucket is empty.
+
+While a bucket is more than half full, the process may take a tenth of
+its tokens locally for up to a second before asking redis again. The
+tokens taken that way are charged to the bucket on the next call, so
+clients far from their limit cost a redis call every few requests only.
+Refused clients are refused locally until their next token is due.
+"""
+
+import hashlib
+import logging
+import math
+import threading
+import time
+
+import redis
+from tornado.escape import utf8
+
+from djinn.datastore import rstore
+
+logger = logging.getLogger(__name__)
+
+# KEYS[1] bucket, ARGV rate, burst, cost, tokens already taken locally.
+# Returns {allowed, tokens left} with tokens as a string, lua numbers being
+# truncated to integers in replies.
+_SCRIPT = """
+if redis.replicate_commands then redis.replicate_commands() end
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local taken = tonumber(ARGV[4])
+local time = redis.call("TIME")
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "ts")
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate) - taken
+local allowed = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+end
+redis.call("HMSET", KEYS[1], "tokens", tokens, "ts", now)
+redis.call("PEXPIRE", KEYS[1], math.ceil(burst / rate * 1000) + 1000)
+return {allowed, tostring(tokens)}
+"""
+_SCRIPT_SHA = hashlib.sha1(utf8(_SCRIPT)).hexdigest()
+
+
+class RateLimiter(object):
+    """Token buckets of burst tokens refilled at rate tokens per second.
+
+    Keys are stored as "<prefix>:<key>" in the rstore instance. Redis
+    errors are logged and let requests through.
+    """
+
+    max_leases = 10000
+
+    def __init__(self, rate, burst, instance="default", prefix="rl",
+                 local_fraction=0.1, local_ttl=1.0):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.instance = instance
+        self.prefix = prefix
+        self.local_fraction = local_fraction
+        self.local_ttl = local_ttl
+        # key -> [tokens the process may take, tokens taken, expiration]
+        self._leases = {}
+        # key -> time until which the key has no tokens
+        self._denied = {}
+        self._lock = threading.Lock()
+
+    def _client(self, key):
+        client = getattr(rstore.manager, self.instance)
+        if isinstance(client, rstore.ShardedRedis):
+            client = client.node(key)
+        return client
+
+    def _call(self, key, cost, taken):
+        client = self._client(key)
+        args = (self.rate, self.burst, cost, taken)
+        try:
+            allowed, tokens = client.evalsha(_SCRIPT_SHA, 1, key, *args)
+        except redis.exceptions.NoScriptError:
+            allowed, tokens = client.eval(_SCRIPT, 1, key, *args)
+        return bool(allowed), float(tokens)
+
+    def take(self, key, cost=1):
+        """Takes cost tokens of key.
+
+        Returns (allowed, retry_after), retry_after being the seconds until
+        enough tokens are back when not allowed.
+        """
+        key = "%s:%s" % (self.prefix, key)
+        now = time.time()
+        with self._lock:
+            denied_until = self._denied.get(key)
+            if denied_until is not None:
+                if denied_until > now and cost <= 1:
+                    return False, denied_until - now
+                del self._denied[key]
+            lease = self._leases.pop(key, None)
+            if lease and lease[2] > now and lease[1] + cost <= lease[0]:
+                lease[1] += cost
+                self._leases[key] = lease
+                return True, 0
+        taken = lease[1] if lease else 0
+
+        try:
+            allowed, tokens = self._call(key, cost, taken)
+        except redis.RedisError as e:
+            logger.warning("Rate limit of %s not checked: %s", key, e)
+            return True, 0
+
+        if allowed and tokens >= self.burst / 2:
+            local = math.floor(tokens * self.local_fraction)
+            if local >= 1:
+                with self._lock:
+                    if len(self._leases) > self.max_leases:
+                        self._leases.clear()
+                    self._leases[key] = [local, 0, now + self.local_ttl]
+        if allowed:
+            return True, 0
+
+        retry_after = (cost - tokens) / self.rate
+        if cost <= 1:
+            with self._lock:
+                if len(self._denied) > self.max_leases:
+                    self._denied.clear()
+                self._denied[key] = now + retry_after
+        return False, retry_after
+
+
+_limiters = {}
+
+
+def limiter(rate_limit, instance="default"):
+    """Returns the shared RateLimiter of rate_limit, a (requests, seconds)
+    or (requests, seconds, burst) tuple."""
+    key = (tuple(rate_limit), instance)
+    limiter_ = _limiters.get(key)
+    if limiter_ is None:
+        requests, seconds = rate_limit[:2]
+        burst = rate_limit[2] if len(rate_limit) > 2 else requests
+        limiter_ = _limiters[key] = RateLimiter(
+            float(requests) / seconds, burst, instance)
+    return limiter_
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright(c) 2014 palmhold.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+"""AsyncMemcacheClient against an in-process stand-in memcached."""
+
+from tornado import gen
+from tornado.iostream import StreamClosedError
+from tornado.tcpserver import TCPServer
+from tornado.testing import (AsyncTestCase, ExpectLog, bind_unused_port,
+                             gen_test)
+
+from djinn.datastore.aiocache import AsyncMemcacheClient
+
+
+class StandInMemcached(TCPServer):
+    """Speaks the part of the memcached text protocol the client uses.
+
+    Every command line received is kept in lines, and the replies to gets
+    are replaced by bad_get_reply when it is set.
+    """
+
+    def __init__(self):
+        super(StandInMemcached, self).__init__()
+        self.store = {}
+        self.lines = []
+        self.connections = 0
+        self.bad_get_reply = None
+
+    @gen.coroutine
+    def handle_stream(self, stream, address):
+        self.connections += 1
+        try:
+            while True:
+                line = yield stream.read_until(b"\r\n")
+                self.lines.append(line[:-2])
+                reply = yield self._reply(stream, line.split())
+                yield stream.write(reply)
+        except StreamClosedError:
+            pass
+
+    @gen.coroutine
+    def _reply(self, stream, parts):
+        command, key = parts[0], parts[1]
+        if command == b"get":
+            if self.bad_get_reply is not None:
+                raise gen.Return(self.bad_get_reply)
+            reply = []
+            for key in parts[1:]:
+                if key in self.store:
+                    flags, data = self.store[key]
+                    reply.append(b"VALUE " + key + b" " + flags + b" " +
+                                 str(len(data)).encode() + b"\r\n" +
+                                 data + b"\r\n")
+            raise gen.Return(b"".join(reply) + b"END\r\n")
+
+        if command in (b"set", b"add"):
+            data = yield stream.read_bytes(int(parts[4]) + 2)
+            if command == b"add" and key in self.store:
+                raise gen.Return(b"NOT_STORED\r\n")
+            self.store[key] = (parts[2], data[:-2])
+            raise gen.Return(b"STORED\r\n")
+
+        if command in (b"incr", b"decr"):
+            if key not in self.store:
+                raise gen.Return(b"NOT_FOUND\r\n")
+            flags, data = self.store[key]
+            delta = int(parts[2]) if command == b"incr" else -int(parts[2])
+            data = str(max(int(data) + delta, 0)).encode()
+            self.store[key] = (flags, data)
+            raise gen.Return(data + b"\r\n")
+
+        if command == b"delete":
+            found = self.store.pop(key, None) is not None
+            raise gen.Return(b"DELETED\r\n" if found else b"NOT_FOUND\r\n")
+
+        raise gen.Return(b"ERROR\r\n")
+
+    def commands(self, command):
+        return [line for line in self.lines
+                if line.split()[0] == command]
+
+
+class AsyncMemcacheClientTest(AsyncTestCase):
+
+    def setUp(self):
+        super(AsyncMemcacheClientTest, self).setUp()
+        sock, port = bind_unused_port()
+        self.server = StandInMemcached()
+        self.server.add_socket(sock)
+        self.client = AsyncMemcacheClient(["127.0.0.1:%d" % port])
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+        super(AsyncMemcacheClientTest, self).tearDown()
+
+    @gen_test
+    def test_set_get(self):
+        self.assertTrue((yield self.client.set("user:1", {"name": "a"})))
+        self.assertEqual((yield self.client.get("user:1")), {"name": "a"})
+        self.assertEqual((yield self.client.get("user:2", "miss")), "miss")
+
+    @gen_test
+    def test_add(self):
+        self.assertTrue((yield self.client.add("lock", 1)))
+        self.assertFalse((yield self.client.add("lock", 2)))
+        self.assertEqual((yield self.client.get("lock")), 1)
+
+    @gen_test
+    def test_incr(self):
+        self.assertIsNone((yield self.client.incr("hits")))
+        yield self.client.set("hits", 1)
+        self.assertEqual((yield self.client.incr("hits", 2)), 3)
+        self.assertEqual((yield self.client.incr("hits", -1)), 2)
+        self.assertEqual((yield self.client.get("hits")), 2)
+
+    @gen_test
+    def test_concurrent_gets_batched(self):
+        yield self.client.set_many(dict(("k%d" % i, i) for i in range(3)))
+        values = yield [self.client.get("k%d" % i) for i in range(4)]
+        self.assertEqual(values, [0, 1, 2, None])
+        gets = self.server.commands(b"get")
+        self.assertEqual(len(gets), 1)
+        self.assertEqual(sorted(gets[0].split()[1:]),
+                         [b"k0", b"k1", b"k2", b"k3"])
+
+    @gen_test
+    def test_get_many_batched(self):
+        mapping = dict(("k%d" % i, [i]) for i in range(250))
+        self.assertEqual((yield self.client.set_many(mapping)), [])
+        connections = self.server.connections
+
+        values = yield self.client.get_many(list(mapping) + ["missing"])
+        self.assertEqual(values, mapping)
+        # 100 keys per get, written back to back on one connection
+        self.assertEqual([len(line.split()) - 1
+                          for line in self.server.commands(b"get")],
+                         [100, 100, 51])
+        self.assertEqual(self.server.connections, connections)
+
+    @gen_test
+    def test_bad_get_reply_resolves_gets(self):
+        yield self.client.set("k", 1)
+        self.server.bad_get_reply = b"VALUE k 0 x\r\n"
+        # reported as a protocol error, not an exception in the callback
+        with ExpectLog("djinn.datastore.aiocache",
+                       "memcache server .* error: .*VALUE k 0 x"):
+            values = yield [self.client.get("k"), self.client.get("k")]
+        self.assertEqual(values, [None, None])